@@ -1,10 +1,15 @@
-import haml
 import webassets
-from webassets.bundle import wrap
-import pathlib
+import webassets.loaders
+from webassets.bundle import wrap, has_placeholder
+from webassets.exceptions import BundleError
+from webassets.cache import FilesystemCache, make_md5
 import os
+import hashlib
 import logging
 import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -30,8 +35,9 @@ class AssetManager(object):
         if production:
             bundles = self._adjust_bundle_outputs(bundles)
 
+        directory = self._resolve_assets_dir()
         env_config = {
-            'directory': self._resolve_assets_dir(),
+            'directory': directory,
             'UGLIFYJS_EXTRA_ARGS': ['-c', '-m'],
             'SASS_DEBUG_INFO': False
         }
@@ -40,7 +46,6 @@ class AssetManager(object):
             env_config.update({
                 'debug': False,
                 'manifest': 'cache',
-                'cache': True,
                 'auto_build': False,
                 'url_expire': True
             })
@@ -48,10 +53,21 @@ class AssetManager(object):
             env_config.update({
                 'debug': 'merge',
                 'manifest': None,
-                'cache': False,
                 'auto_build': False,
                 'url_expire': False
             })
+        # the options changing the output of the filters, part of the key
+        # of the bundles in the cache
+        self._config_key = repr(sorted(env_config.items()))
+
+        # filter results and built bundles, kept across runs in both modes
+        cache = False
+        if directory is not None and self.cache_size:
+            cache = BoundedFilesystemCache(
+                os.path.join(directory, '.webassets-cache'), self.cache_size)
+        env_config['cache'] = cache
+        if production and not cache:
+            env_config['manifest'] = None
 
         environment = webassets.Environment(**env_config)
         environment.url= ''
@@ -61,12 +77,30 @@ class AssetManager(object):
             environment.register(name, bundle)
         return environment
 
-    def __init__(self, config_path, production=False):
+    def __init__(self, config_path, production=False, workers=None,
+            cache_size=64 * 1024 * 1024):
         log.debug("production %s" % production)
+        # number of bundles built at the same time
+        self.workers = workers or multiprocessing.cpu_count()
+        # maximum size in bytes of the cache directory, 0 to disable it
+        self.cache_size = cache_size
+        # (path, mtime, size) -> sha1 of the files of the bundles
+        self._digests = {}
+        # seconds spent building each bundle and in each of its filters
+        # during the last build, see build_bundles
+        self.last_build_report = None
         bundles = self._load_asset_bundles(config_path)
         self.environment = self._setup_environment(bundles, production)
+        # number of calls to build_environment, so that users of the asset
+        # urls know when to get them again
+        self.builds = 0
+        self._asset_urls = None
+        self._versioned_outputs = None
 
     def _resolve_assets_dir(self):
+        # the first directory os.walk would give, without walking the tree
+        if os.path.isdir('assets'):
+            return os.path.join('.', 'assets')
         for dirpath, dirnames, files in os.walk('.'):
             if 'assets' in dirnames:
                 return os.path.join(dirpath, 'assets')
@@ -99,17 +133,496 @@ class AssetManager(object):
                     globs.extend(bundle.depends)
         return globs
 
+    def bundle_files(self):
+        """
+        Maps the path of every file the named bundles are made of or depend
+        on to the names of the bundles using it. Globs are resolved again on
+        each call, so that new files are seen.
+        """
+        files = {}
+        if not self.environment:
+            return files
+        for name, bundle in self.environment._named_bundles.iteritems():
+            try:
+                paths = _bundle_files(bundle, wrap(self.environment, bundle))
+            except (BundleError, IOError) as e:
+                log.warning("cannot resolve the files of %s: %s" % (name, e))
+                continue
+            for path in paths:
+                files.setdefault(path, set()).add(name)
+        return files
+
+    def bundle_outputs(self, names):
+        """
+        Absolute paths of the outputs of the named bundles.
+        """
+        named = self.environment._named_bundles
+        outputs = set()
+        for name in names:
+            if not named[name].output:
+                continue
+            try:
+                outputs.add(os.path.abspath(named[name].resolve_output()))
+            except BundleError:
+                # a version that cannot be determined
+                pass
+        return outputs
+
+    def _built(self):
+        self.builds += 1
+        self._asset_urls = None
+        self._versioned_outputs = None
+
     def build_environment(self, force=False):
         if self.environment:
             log.debug("building environment...")
             if force:
                 log.debug("forcing update...")
-            for bundle in self.environment:
-                bundle.build(force=force)
+            self.build_bundles(list(self.environment._named_bundles), force)
+        else:
+            self._built()
+
+    def _bundle_dependencies(self, names):
+        """
+        Maps each of the named bundles to the names of the bundles it must
+        be built after: those whose output is one of its inputs, and those
+        it contains.
+        """
+        named = self.environment._named_bundles
+        outputs = dict((bundle.output, name)
+            for name, bundle in named.iteritems() if bundle.output)
+        ids = dict((id(bundle), name) for name, bundle in named.iteritems())
+        dependencies = {}
+        for name in names:
+            deps = set()
+            pending = list(named[name].contents)
+            while pending:
+                item = pending.pop()
+                if isinstance(item, webassets.Bundle):
+                    if id(item) in ids:
+                        deps.add(ids[id(item)])
+                    pending.extend(item.contents)
+                elif item in outputs:
+                    deps.add(outputs[item])
+            deps.discard(name)
+            dependencies[name] = deps & set(names)
+        return dependencies
+
+    def build_bundles(self, names, force=False):
+        """
+        Builds the named bundles, up to self.workers at the same time, each
+        one after the bundles it depends on. The time spent on each bundle,
+        and in each filter of each bundle, is logged and kept in
+        last_build_report.
+        """
+        named = self.environment._named_bundles
+        dependencies = self._bundle_dependencies(names)
+        report = {"bundles": {}, "filters": {}, "cached": []}
+        current = threading.local()
+        lock = threading.Lock()
+        done = threading.Condition(lock)
+        state = {"running": 0, "error": None}
+        built = set()
+        start = time.time()
+
+        def build(name):
+            current.name = name
+            before = time.time()
+            try:
+                if self._restore(name):
+                    with lock:
+                        report["cached"].append(name)
+                else:
+                    key = self._bundle_key(named[name])
+                    named[name].build(force=force)
+                    self._store(name, key)
+            except Exception as e:
+                log.exception("failed to build %s" % name)
+                with lock:
+                    state["error"] = state["error"] or e
+            with lock:
+                report["bundles"][name] = time.time() - before
+                built.add(name)
+                state["running"] -= 1
+                done.notify()
+
+        def filter_time(filter_name, seconds):
+            with lock:
+                times = report["filters"].setdefault(current.name, {})
+                times[filter_name] = times.get(filter_name, 0) + seconds
+
+        with _timed_filters([named[name] for name in names], filter_time):
+            pending = list(names)
+            with lock:
+                while pending and state["error"] is None:
+                    ready = [name for name in pending
+                        if dependencies[name] <= built]
+                    if not ready and not state["running"]:
+                        # a dependency cycle, build the rest in order
+                        ready = pending[:1]
+                    for name in ready[:self.workers - state["running"]]:
+                        pending.remove(name)
+                        state["running"] += 1
+                        thread = threading.Thread(target=build, args=(name,))
+                        thread.daemon = True
+                        thread.start()
+                    done.wait()
+                while state["running"]:
+                    done.wait()
+        self._built()
+        report["total"] = time.time() - start
+        self.last_build_report = report
+        for name, seconds in sorted(report["bundles"].items(),
+                key=lambda item: -item[1]):
+            filters = report["filters"].get(name, {})
+            log.info("%s %s in %.3fs%s" % ("restored" if name in
+                report["cached"] else "built", name, seconds,
+                "".join(", %s %.3fs" % item for item in
+                    sorted(filters.items(), key=lambda item: -item[1]))))
+        if state["error"] is not None:
+            raise state["error"]
+
+    def _file_digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha.update(chunk)
+            digest = self._digests[key] = sha.hexdigest()
+        return digest
+
+    def _bundle_key(self, bundle):
+        """
+        Hash of what the output of a bundle is made of: the content of its
+        files and of their depends, its filters and the options of the
+        environment. None if the bundle cannot be cached.
+        """
+        env = self.environment
+        if not env.cache:
+            return None
+        sha = hashlib.sha1()
+        for part in (webassets.__version__, self._config_key, bundle.output,
+                bundle.debug):
+            sha.update(repr(part).encode('utf-8') + b'\0')
+        pending = [bundle]
+        while pending:
+            b = pending.pop()
+            for f in b.filters:
+                sha.update(f.id().encode('utf-8') + b'\0')
+            for item in b.contents:
+                if isinstance(item, webassets.Bundle):
+                    if item.output:
+                        # it is built too, not only read
+                        return None
+                    pending.append(item)
+        try:
+            files = _bundle_files(bundle, wrap(env, bundle))
+            for path in files:
+                sha.update(path.encode('utf-8') + b'\0' +
+                    self._file_digest(path).encode('ascii'))
+        except (BundleError, IOError, OSError):
+            return None
+        return sha.hexdigest()
+
+    def _restore(self, name):
+        """
+        Writes the output of the named bundle from the cache if it was
+        built from the same inputs before. Returns whether it did.
+        """
+        bundle = self.environment._named_bundles[name]
+        key = self._bundle_key(bundle)
+        entry = key and self.environment.cache.get(('pygreen-bundle', key))
+        if not entry:
+            return False
+        ctx = wrap(self.environment, bundle)
+        output = os.path.join(self.environment.directory, entry['output'])
+        try:
+            with open(output, 'rb') as f:
+                same = f.read() == entry['data']
+        except IOError:
+            same = False
+        if not same:
+            directory = os.path.dirname(output)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(output, 'wb') as f:
+                f.write(entry['data'])
+        version = entry['version']
+        bundle.version = version
+        if ctx.manifest:
+            ctx.manifest.remember(bundle, ctx, version)
+        if ctx.versions and version:
+            ctx.versions.set_version(bundle, ctx, output, version)
+        return True
+
+    def _store(self, name, key):
+        """
+        Keeps the output of the named bundle, just built from the inputs
+        hashed as key, in the cache.
+        """
+        bundle = self.environment._named_bundles[name]
+        if key is None or key != self._bundle_key(bundle):
+            # changed while it was built
+            return
+        output = bundle.resolve_output(version=bundle.version or None)
+        with open(output, 'rb') as f:
+            data = f.read()
+        self.environment.cache.set(('pygreen-bundle', key), {
+            'output': os.path.relpath(output, self.environment.directory),
+            'version': bundle.version or None,
+            'data': data,
+        })
 
     def asset_urls(self):
-        urls = {}
-        for name, bundle in self.environment._named_bundles.iteritems():
-            urls[name] = [url.split('?')[0] for url in bundle.urls()]
-        return urls
+        """
+        Urls of the files of each named bundle, kept until the next build
+        """
+        if self._asset_urls is None:
+            urls = {}
+            if self.environment:
+                for name, bundle in self.environment._named_bundles.iteritems():
+                    urls[name] = [url.split('?')[0] for url in bundle.urls()]
+            self._asset_urls = urls
+        return self._asset_urls
+
+    def versioned_outputs(self):
+        """
+        Absolute paths of the outputs of the named bundles having their
+        version in their name, kept until the next build
+        """
+        if self._versioned_outputs is None:
+            outputs = set()
+            if self.environment:
+                for name, bundle in self.environment._named_bundles.iteritems():
+                    if not bundle.output or not has_placeholder(bundle.output):
+                        continue
+                    try:
+                        outputs.add(os.path.abspath(bundle.resolve_output()))
+                    except BundleError:
+                        # not built yet
+                        pass
+            self._versioned_outputs = outputs
+        return self._versioned_outputs
+
+
+
+class BoundedFilesystemCache(FilesystemCache):
+    """
+    A webassets FilesystemCache keeping its directory under max_size bytes
+    by removing the least recently used entries. It can be shared by
+    several processes.
+    """
+
+    def __init__(self, directory, max_size):
+        FilesystemCache.__init__(self, directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, '%s' % make_md5(self.V, key))
+
+    def get(self, key):
+        result = FilesystemCache.get(self, key)
+        if result is not None:
+            # the mtime of an entry is its last use
+            try:
+                os.utime(self._filename(key), None)
+            except OSError:
+                pass
+        return result
+
+    def set(self, key, data):
+        FilesystemCache.set(self, key, data)
+        try:
+            size = os.stat(self._filename(key)).st_size
+        except OSError:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._entries_size()
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                # temporary file of another process
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def _entries_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self._size -= size
+        log.debug("asset cache evicted down to %d bytes" % self._size)
+
+
+class BundleRebuilder(object):
+    """
+    A callback for file watchers that rebuilds only the bundles using the
+    files created, modified or deleted since its previous call. Changes
+    coming less than debounce seconds apart are built as one batch.
+
+    By default the call waits for the batch with time.sleep. With
+    schedule(seconds, func), like the add_timeout of an event loop, it
+    returns at once and the batch is built by a later call of func, after
+    which built(names) is called.
+    """
+
+    def __init__(self, manager, debounce=0.1, schedule=None, built=None):
+        self.manager = manager
+        self.debounce = debounce
+        self.schedule = schedule
+        self.built = built
+        self._files = {}
+        self._mtimes = {}
+        self._waiting = None
+        self._changes()
+
+    def _changes(self, ignore=()):
+        """
+        Returns the names of the bundles using the files that changed since
+        the last call, except the files in ignore.
+        """
+        files = self.manager.bundle_files()
+        mtimes = {}
+        for path in files:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                pass
+        names = set()
+        for path in set(mtimes) | set(self._mtimes):
+            if mtimes.get(path) != self._mtimes.get(path) and \
+                    os.path.abspath(path) not in ignore:
+                names.update(files.get(path, ()))
+                names.update(self._files.get(path, ()))
+        self._files, self._mtimes = files, mtimes
+        return names
+
+    def _with_dependents(self, names):
+        dependencies = self.manager._bundle_dependencies(
+            list(self.manager.environment._named_bundles))
+        names = set(names)
+        added = True
+        while added:
+            added = [name for name, deps in dependencies.items()
+                if name not in names and deps & names]
+            names.update(added)
+        return names
+
+    def _step(self, names):
+        """
+        Builds the named bundles, with their dependents, unless more files
+        changed during the last debounce time. Returns the names of the
+        bundles to build after the next one.
+        """
+        more = self._changes()
+        if more:
+            return names | more
+        names = self._with_dependents(names)
+        log.info("rebuilding %s" % ", ".join(sorted(names)))
+        self.manager.build_bundles(sorted(names), force=True)
+        if self.built is not None:
+            self.built(names)
+        # the outputs just built are inputs of some of these bundles, the
+        # other files were changed during the build
+        return self._changes(ignore=self.manager.bundle_outputs(names))
+
+    def _scheduled(self):
+        names, self._waiting = self._waiting, None
+        self._waiting = self._step(names) or None
+        if self._waiting:
+            self.schedule(self.debounce, self._scheduled)
+
+    def __call__(self):
+        names = self._changes()
+        if self.schedule is None:
+            while names:
+                time.sleep(self.debounce)
+                names = self._step(names)
+        elif self._waiting is not None:
+            self._waiting |= names
+        elif names:
+            self._waiting = names
+            self.schedule(self.debounce, self._scheduled)
+
+
+def _bundle_files(bundle, ctx):
+    """
+    Paths of the files of a bundle and of the bundles it contains, with their
+    depends.
+    """
+    files = []
+    for _, item in bundle.resolve_contents(ctx, force=True):
+        if isinstance(item, webassets.Bundle):
+            files.extend(_bundle_files(item, wrap(ctx, item)))
+        elif os.path.isabs(item):
+            files.append(item)
+    for pattern in bundle.depends or ():
+        result = ctx.resolver.resolve_source(ctx, pattern)
+        files.extend(result if isinstance(result, list) else [result])
+    return files
+
+
+@contextmanager
+def _timed_filters(bundles, record):
+    """
+    Wraps the methods of the filters of the bundles, and of the bundles they
+    contain, so that record(filter_name, seconds) is called after each call.
+    """
+    def timed(func, name):
+        def wrapper(*args, **kwargs):
+            before = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.time() - before)
+        return wrapper
 
+    wrapped = []
+    seen = set()
+    pending = list(bundles)
+    while pending:
+        bundle = pending.pop()
+        pending.extend(c for c in bundle.contents
+            if isinstance(c, webassets.Bundle))
+        for f in bundle.filters:
+            if id(f) in seen:
+                continue
+            seen.add(id(f))
+            for method in ("open", "input", "concat", "output"):
+                func = getattr(f, method, None)
+                if func:
+                    setattr(f, method, timed(func, f.name or
+                        type(f).__name__))
+                    wrapped.append((f, method))
+    try:
+        yield
+    finally:
+        for f, method in wrapped:
+            delattr(f, method)
@@ -0,0 +1,62 @@
+#! /usr/bin/python
+"""
+Compares the pages/sec of rendering a site file by file through PyGreen.get
+(one Flask app and test client per file) with the renderer used by gen_static
+(one Flask app for the whole run).
+
+    python benchmarks/bench_render.py --pages 500
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, ".."))
+sys.path.insert(0, _here)
+
+import pygreen
+import sitegen
+
+
+def bench(label, render, files):
+    start = time.time()
+    results = [render(f) for f in files]
+    elapsed = time.time() - start
+    print("%-10s %6d files in %7.3fs  %8.1f pages/sec"
+        % (label, len(files), elapsed, len(files) / elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--pages", type=int, default=200,
+        help="number of template pages (and as many static files)")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="pygreen-bench-")
+    try:
+        # plain Mako pages inheriting one layout
+        sitegen.make_site(folder, pages=args.pages, depth=1, haml=0,
+            markdown=0)
+        green = pygreen.PyGreen()
+        green.set_folder(folder)
+        files = sorted(sum((l() for l in green.file_listers), []))
+
+        before = bench("get", green.get, files)
+        after = bench("renderer", green.renderer(), files)
+        if before != after:
+            print("output differs between get and renderer")
+            return 1
+    finally:
+        shutil.rmtree(folder)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#! /usr/bin/python
+"""
+Measures the startup time of PyGreen: importing the module, and running the
+gen command on a site where nothing changed, each in a new process.
+
+    python benchmarks/bench_startup.py --runs 10 --output startup.json
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _here)
+
+import sitegen
+
+PYGREEN = os.path.join(_here, "..", "pygreen.py")
+
+
+def run(command, cwd, runs):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(_here, "..")] +
+        [p for p in [env.get("PYTHONPATH")] if p])
+    times = []
+    with open(os.devnull, "wb") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, cwd=cwd, env=env,
+                stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return {"min": min(times), "mean": sum(times) / len(times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+        help="number of processes started for each measure")
+    parser.add_argument("--pages", type=int, default=5,
+        help="number of pages of the site given to gen")
+    parser.add_argument("--output", default=None,
+        help="file to write the results into, as JSON")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="pygreen-bench-")
+    try:
+        site = os.path.join(folder, "site")
+        output = os.path.join(folder, "output")
+        sitegen.make_site(site, pages=args.pages)
+        gen = [sys.executable, PYGREEN, "gen", output, "-i"]
+        subprocess.check_call(gen, cwd=site, stdout=open(os.devnull, "wb"),
+            stderr=subprocess.STDOUT)
+        results = {
+            "python": run([sys.executable, "-c", "pass"], folder, args.runs),
+            "import": run([sys.executable, "-c", "import pygreen"], folder,
+                args.runs),
+            "gen_unchanged": run(gen, site, args.runs),
+        }
+    finally:
+        shutil.rmtree(folder)
+
+    for name in sorted(results):
+        print("%-15s min %7.3fs  mean %7.3fs" % (name, results[name]["min"],
+            results[name]["mean"]))
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(json.dumps({"params": {"pages": args.pages},
+                "results": results}, indent=2, sort_keys=True).encode("utf-8"))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
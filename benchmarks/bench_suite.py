@@ -0,0 +1,228 @@
+#! /usr/bin/python
+"""
+Runs the PyGreen benchmarks against a synthetic site and saves the results
+as JSON.
+
+    python benchmarks/bench_suite.py --pages 500 --depth 3 --bundles 4 \\
+        --output results.json
+    python benchmarks/bench_suite.py --pages 500 --compare results.json
+
+Measured: the latency of PyGreen.get, the pages/sec of gen_static, the time
+to compile the templates with an empty and with a filled module cache, the
+time to build the asset bundles, and the requests/sec of the serve app
+through a WSGI test client, before and after its response cache is filled.
+With --compare, the results are compared with those of a previous run and
+the exit status is 1 if one of them is worse by more than --threshold.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# absolute, the benchmarks are run from the folder of the site
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, ".."))
+sys.path.insert(0, _here)
+
+import pygreen
+import sitegen
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+# for each result, whether a higher value is better
+HIGHER_IS_BETTER = {
+    "get_mean_ms": False,
+    "get_p95_ms": False,
+    "gen_pages_per_sec": True,
+    "gen_parallel_pages_per_sec": True,
+    "compile_cold_sec": False,
+    "compile_warm_sec": False,
+    "assets_build_sec": False,
+    "serve_cold_requests_per_sec": True,
+    "serve_warm_requests_per_sec": True,
+}
+
+
+def _green(folder):
+    green = pygreen.PyGreen()
+    green.set_folder(folder)
+    green.config_file = os.path.join(folder, "default.cfg")
+    green.set_production(False)
+    return green
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def bench_get(folder, paths, samples):
+    green = _green(folder)
+    latencies = []
+    for path in paths[:samples]:
+        start = time.time()
+        green.get(path)
+        latencies.append((time.time() - start) * 1000)
+    return {
+        "get_mean_ms": sum(latencies) / len(latencies),
+        "get_p95_ms": _percentile(latencies, 95),
+    }
+
+
+def bench_gen(folder, jobs):
+    results = {}
+    for name, count in [("gen", 1), ("gen_parallel", jobs)]:
+        if count < 2 and name == "gen_parallel":
+            continue
+        green = _green(folder)
+        output = tempfile.mkdtemp(prefix="pygreen-bench-out-")
+        try:
+            start = time.time()
+            green.gen_static(output, jobs=count)
+            elapsed = time.time() - start
+            files = sum(len(l()) for l in green.file_listers)
+        finally:
+            shutil.rmtree(output)
+        results["%s_pages_per_sec" % name] = files / elapsed
+    return results
+
+
+def bench_compile(folder):
+    cache = pygreen.site_cache_dir(folder)
+    if os.path.exists(cache):
+        shutil.rmtree(cache)
+    results = {}
+    for name in ("compile_cold_sec", "compile_warm_sec"):
+        # a new instance has no template in memory, only the modules
+        # written into the cache directory by the previous one
+        green = _green(folder)
+        start = time.time()
+        failed = green.compile_templates()
+        results[name] = time.time() - start
+        if failed:
+            raise Exception("templates failed to compile: %s"
+                % ", ".join(failed))
+    return results
+
+
+def bench_assets(folder):
+    green = _green(folder)
+    start = time.time()
+    green.manager.build_environment(force=True)
+    return {"assets_build_sec": time.time() - start}
+
+
+def bench_serve(folder, paths, rounds):
+    green = _green(folder)
+    app = pygreen.create_app(root_path=folder, config_file=green.config_file)
+    pygreen.configure_views(app, green._serve_renderer(),
+        static_sender=green.send_static)
+    client = Client(app, BaseResponse)
+    urls = ["/" + p for p in paths] + \
+        ["/static/file%d.txt" % i for i in range(len(paths))]
+    results = {}
+    for name in ("serve_cold", "serve_warm"):
+        start = time.time()
+        count = 0
+        for _ in range(rounds if name == "serve_warm" else 1):
+            for url in urls:
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise Exception("%s: %s" % (url, response.status))
+                count += 1
+        results["%s_requests_per_sec" % name] = count / (time.time() - start)
+    return results
+
+
+def compare(results, previous, threshold):
+    """
+    Prints the ratio of each result to the previous one, returns the names
+    of the results worse by more than threshold.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in previous or not previous[name]:
+            continue
+        ratio = results[name] / previous[name]
+        worse = ratio < 1 - threshold if HIGHER_IS_BETTER[name] \
+            else ratio > 1 + threshold
+        if worse:
+            regressions.append(name)
+        print("%-30s %12.3f %12.3f %7.2fx%s" % (name, previous[name],
+            results[name], ratio, "  REGRESSION" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    sitegen.add_arguments(parser)
+    parser.add_argument("--samples", type=int, default=50,
+        help="number of pages fetched with PyGreen.get")
+    parser.add_argument("--jobs", type=int, default=0,
+        help="processes of the parallel gen_static run, 0 for one per CPU, "
+        "1 to skip it")
+    parser.add_argument("--rounds", type=int, default=3,
+        help="number of times every url is requested once the response "
+        "cache is filled")
+    parser.add_argument("--output", default=None,
+        help="file to write the results into, as JSON")
+    parser.add_argument("--compare", default=None,
+        help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative difference above which a result is a regression")
+    args = parser.parse_args()
+
+    params = sitegen.site_arguments(args)
+    folder = tempfile.mkdtemp(prefix="pygreen-bench-")
+    cwd = os.getcwd()
+    results = {}
+    try:
+        paths = sitegen.make_site(folder, **params)
+        # the asset manager looks for assets.yml and the assets folder in
+        # the current directory
+        os.chdir(folder)
+        for bench in (
+                lambda: bench_assets(folder),
+                lambda: bench_compile(folder),
+                lambda: bench_get(folder, paths, args.samples),
+                lambda: bench_gen(folder,
+                    args.jobs or pygreen.multiprocessing.cpu_count()),
+                lambda: bench_serve(folder, paths, args.rounds)):
+            results.update(bench())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+
+    for name in sorted(results):
+        print("%-30s %12.3f" % (name, results[name]))
+    report = {
+        "params": params,
+        "python": platform.python_version(),
+        "time": time.time(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(json.dumps(report, indent=2,
+                sort_keys=True).encode("utf-8"))
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            previous = json.loads(f.read().decode("utf-8"))
+        if previous["params"] != params:
+            print("warning: the previous run used other parameters: %s"
+                % previous["params"])
+        print("")
+        if compare(results, previous["results"], args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#! /usr/bin/python
+"""
+Generates a synthetic PyGreen site to benchmark against.
+
+    python benchmarks/sitegen.py /tmp/site --pages 500 --depth 3 --bundles 4
+
+The site has a chain of depth layouts, each one inheriting the previous one,
+and pages inheriting the last layout. A share of the pages are written in
+HAML, another one is mostly markdown converted by the smartydown filter.
+Every page also has a static file next to it, and the layout links the
+asset bundles defined in assets.yml.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import io
+import os
+import os.path
+
+
+MARKDOWN = """
+Section %(i)d
+==========
+
+Some *emphasis*, some **strong** text, "quotes" -- and dashes...
+
+* item one of page %(i)d
+* item [two](page%(next)d.mako)
+* item three
+
+---
+
+    a code block
+    of two lines
+
+Last paragraph of the page.
+"""
+
+
+def _write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def _layouts(folder, depth):
+    layouts = os.path.join(folder, "templates", "layouts")
+    _write(os.path.join(layouts, "base0.mako"),
+        "<html><head>\n"
+        "% for name in sorted(asset_urls):\n"
+        "% for url in asset_urls[name]:\n"
+        "<script src=\"${url}\"></script>\n"
+        "% endfor\n"
+        "% endfor\n"
+        "</head><body>${next.body()}</body></html>\n")
+    for level in range(1, depth):
+        _write(os.path.join(layouts, "base%d.mako" % level),
+            "<%%inherit file=\"base%d.mako\"/>\n"
+            "<div class=\"level%d\">${next.body()}</div>\n"
+            % (level - 1, level))
+    return "layouts/base%d.mako" % (max(depth, 1) - 1)
+
+
+def _page(i, pages, kind, layout):
+    params = {"i": i, "next": (i + 1) % pages, "layout": layout}
+    if kind == "haml":
+        return "page%d.haml" % i, (
+            "%%%%inherit(file=\"%(layout)s\")\n"
+            "%%div.page\n"
+            "  %%h1 Page ${%(i)d + 1}\n"
+            "  %%p This page was written in HAML.\n"
+            "  %%a(href=\"page%(next)d.mako\") next\n" % params)
+    if kind == "markdown":
+        return "page%d.mako" % i, (
+            "<%%inherit file=\"%(layout)s\"/>\n"
+            "<%%block filter=\"smartydown\">\n" % params +
+            MARKDOWN % params +
+            "</%block>\n")
+    return "page%d.mako" % i, (
+        "<%%inherit file=\"%(layout)s\"/>\n"
+        "<h1>Page ${%(i)d + 1}</h1>\n"
+        "%% for j in range(10):\n"
+        "<p>line ${j} of page %(i)d</p>\n"
+        "%% endfor\n"
+        "<a href=\"page%(next)d.mako\">next</a>\n" % params)
+
+
+def _bundles(folder, bundles, files_per_bundle=3):
+    config = []
+    for b in range(bundles):
+        config.append("bundle%d:\n  output: gen/bundle%d.js\n  contents:\n"
+            % (b, b))
+        for f in range(files_per_bundle):
+            path = "js/bundle%d/file%d.js" % (b, f)
+            config.append("    - %s\n" % path)
+            _write(os.path.join(folder, "assets", path),
+                "function bundle%d_file%d() {\n    return %d;\n}\n"
+                % (b, f, f) * 20)
+    if config:
+        _write(os.path.join(folder, "assets.yml"), "".join(config))
+
+
+def make_site(folder, pages=100, depth=2, haml=0.2, markdown=0.2,
+        bundles=0):
+    """
+    Writes a site of pages pages into folder. haml and markdown are the
+    shares of the pages written in HAML and mostly in markdown. Returns the
+    list of the paths of the pages, relative to folder.
+    """
+    layout = _layouts(folder, depth)
+    haml_pages = int(round(pages * haml))
+    markdown_pages = int(round(pages * markdown))
+    paths = []
+    for i in range(pages):
+        if i < haml_pages:
+            kind = "haml"
+        elif i < haml_pages + markdown_pages:
+            kind = "markdown"
+        else:
+            kind = "mako"
+        name, content = _page(i, pages, kind, layout)
+        _write(os.path.join(folder, "templates", name), content)
+        _write(os.path.join(folder, "static", "file%d.txt" % i),
+            "static %d\n" % i)
+        paths.append("templates/" + name)
+    _bundles(folder, bundles)
+    _write(os.path.join(folder, "default.cfg"), "SITE_NAME = 'bench'\n")
+    return paths
+
+
+def add_arguments(parser):
+    parser.add_argument("--pages", type=int, default=200,
+        help="number of template pages (and as many static files)")
+    parser.add_argument("--depth", type=int, default=2,
+        help="number of layouts in the inheritance chain of each page")
+    parser.add_argument("--haml", type=float, default=0.2,
+        help="share of the pages written in HAML")
+    parser.add_argument("--markdown", type=float, default=0.2,
+        help="share of the pages made of markdown")
+    parser.add_argument("--bundles", type=int, default=0,
+        help="number of asset bundles in assets.yml")
+
+
+def site_arguments(args):
+    return dict(pages=args.pages, depth=args.depth, haml=args.haml,
+        markdown=args.markdown, bundles=args.bundles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("folder", help="folder to write the site into")
+    add_arguments(parser)
+    args = parser.parse_args()
+    paths = make_site(args.folder, **site_arguments(args))
+    print("%d pages written into %s" % (len(paths), args.folder))
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,99 @@
 from smartypants import smartypants
-from markdown import markdown
+from markdown import Markdown
+import collections
+import hashlib
 import re
+import threading
 
 
-def smartydown(val):
-    return smartypants(markdown(val))
+hr_patt = re.compile('<hr \/>')
+section_break = r'</article>\n<article class="column">'
 
-def sectionize(val):
-    hr_patt = re.compile('<hr \/>')
-    content = smartydown(val)
-    repl = r'</article>\n<article class="column">'
+# a single Markdown instance, reset before each conversion, is much cheaper
+# than the one built by every call to markdown.markdown
+_markdown = Markdown()
+_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """
+    Results of the filters, keyed by the filter name and a hash of the
+    content, so that blocks shared by many pages are converted only once.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+        self._entries[key] = value
+
+    def clear(self):
+        self._entries.clear()
+
+
+cache = LRUCache()
+
+
+def set_cache_size(size):
+    """
+    Sets the number of converted blocks kept in memory, 0 to disable. The
+    cache is emptied and its counters reset.
+    """
+    with _lock:
+        cache.size = size
+        cache.clear()
+        cache.hits = 0
+        cache.misses = 0
+
+
+def _key(name, val):
+    if not isinstance(val, bytes):
+        val = val.encode('utf-8')
+    return name, hashlib.sha1(val).hexdigest()
+
+
+def _convert(key, convert, val):
+    # must be called with _lock held
+    rv = cache.get(key)
+    if rv is None:
+        rv = convert(val)
+        cache.put(key, rv)
+    return rv
+
+
+def _cached(name, convert, val):
+    key = _key(name, val)
+    with _lock:
+        return _convert(key, convert, val)
+
+
+def _smartydown(val):
+    return smartypants(_markdown.reset().convert(val))
+
+
+def _sectionize(val):
+    content = _smartydown(val)
     if hr_patt.search(content):
         classname = "two-column"
-        content = hr_patt.sub(repl, content)
+        content = hr_patt.sub(section_break, content)
     else:
         classname = "one-column"
     rv = '\n'.join((
@@ -22,5 +103,24 @@ def sectionize(val):
         '</article>',
         '</section>'
     ))
-    # print rv
     return rv
+
+
+def smartydown(val):
+    return _cached('smartydown', _smartydown, val)
+
+def sectionize(val):
+    return _cached('sectionize', _sectionize, val)
+
+def smartydown_many(values):
+    """
+    Converts a list of markdown blocks at once, returns the list of results.
+    Blocks appearing more than once are converted once.
+    """
+    keys = [_key('smartydown', val) for val in values]
+    results = {}
+    with _lock:
+        for key, val in zip(keys, values):
+            if key not in results:
+                results[key] = _convert(key, _smartydown, val)
+    return [results[key] for key in keys]
@@ -25,9 +25,9 @@
 from __future__ import unicode_literals, print_function
 
 import flask
-from flask.ext.assets import Environment, Bundle
 from flask.config import Config as FlaskConfig
 import os.path
+import mako
 from mako.lookup import TemplateLookup
 from mako.lexer import Lexer
 import os
@@ -38,15 +38,57 @@ import logging
 import re
 import argparse
 import sys
-import markdown
 import pathlib
-import haml
 import shutil
-from assetmanager import AssetManager
-from livereload import Server
+import multiprocessing
+import traceback
+import ast
+import hashlib
+import json
+import threading
+import collections
+import gzip
+import io
+import mimetypes
+import time
+import cProfile
+import csv
+import posixpath
+import select
+import socket
+import signal
+import errno
+import fcntl
+import tempfile
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from contextlib import contextmanager
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 _logger = logging.getLogger(__name__)
 
+
+class GenerationError(Exception):
+    """
+    Raised when some files could not be generated. errors maps each failed
+    path to the traceback of its failure.
+    """
+    def __init__(self, errors):
+        super(GenerationError, self).__init__(
+            "%d file(s) could not be generated: %s"
+            % (len(errors), ", ".join(sorted(errors))))
+        self.errors = errors
+
+
 def create_app(static_folder='static', template_folder=None,
         root_path=".", config_file=None):
     app = flask.Flask('pygreen',
@@ -54,9 +96,23 @@ def create_app(static_folder='static', template_folder=None,
     app.root_path = root_path
     if config_file:
         app.config.from_pyfile(config_file)
+    app.wsgi_app = _native_headers(app.wsgi_app)
+    return app
+
+def _native_headers(wsgi_app):
+    """
+    Strict WSGI servers, like wsgiref or gunicorn, want the status and the
+    header names as native strings, while this module uses unicode ones.
+    """
+    def app(environ, start_response):
+        def native_start_response(status, headers, exc_info=None):
+            return start_response(str(status),
+                [(str(name), value) for name, value in headers], exc_info)
+        return wsgi_app(environ, native_start_response)
     return app
 
-def configure_views(app, file_renderer, postprocessor=None):
+def configure_views(app, file_renderer, postprocessor=None,
+        static_sender=None):
     app.add_url_rule('/', "root",
         lambda: file_renderer('index.haml', postprocessor),
         methods=['GET', 'POST', 'PUT', 'DELETE']
@@ -65,28 +121,1451 @@ def configure_views(app, file_renderer, postprocessor=None):
         lambda path: file_renderer(path, postprocessor),
         methods=['GET', 'POST', 'PUT', 'DELETE']
     )
+    if static_sender and app.has_static_folder:
+        # static_sender(path) sends the file at path, relative to the root
+        # path of the app, in place of the static view of flask
+        static_folder = os.path.relpath(app.static_folder, app.root_path)
+        app.view_functions["static"] = lambda filename: static_sender(
+            flask.safe_join(static_folder, filename))
+
+
+def render_response(app, file_renderer, path, postprocessor=None):
+    """
+    Renders path through file_renderer inside a request context of app and
+    returns the body of the response. The same app can be reused for many
+    paths, which avoids building a Flask app, its URL map and a test client
+    for each of them.
+    """
+    with app.test_request_context("/%s" % path):
+        try:
+            rv = file_renderer(path or 'index.haml', postprocessor)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        response = app.process_response(app.make_response(rv))
+        # files from send_file are wrapped for the WSGI server, read them here
+        response.direct_passthrough = False
+        try:
+            return response.get_data()
+        finally:
+            response.close()
+
 
+# encodings of the precompressed files, by order of preference, with the
+# extension of their files
+PRECOMPRESSED_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
 
-def change_href_to_html(val):
-    pattern = r'\.(haml|mako)'
-    return re.sub(pattern, '.html', val)
+# max-age of the versioned outputs of the asset bundles, whose name changes
+# with their content
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def send_static(path, immutable=False):
+    """
+    Sends a static file, path being relative to the root path of the app,
+    through the file wrapper of the WSGI server, which can use sendfile. The
+    response has an ETag and a Last-Modified date, is a 304 Not Modified when
+    the client has the file already, and holds only the requested bytes when
+    a single byte range is asked for.
+    If the client accepts it, the .br or .gz version of the file written by
+    Precompressor is sent instead, when the index of the Precompressor for
+    the root path lists it for the current content of the file.
+    Immutable files are cached by the clients for IMMUTABLE_MAX_AGE seconds.
+    """
+    request = flask.request
+    byte_range = _single_byte_range(request)
+    root = flask.current_app.root_path
+    full = os.path.join(root, path)
+    sent, encoding = path, None
+    # other .gz or .br files next to it are not its compressed versions
+    compressed_digest = _compressed_index(root).get(path)
+    variants = compressed_digest is not None and \
+        compressed_digest == _static_digest(full)
+    for ext_encoding, ext in PRECOMPRESSED_ENCODINGS if variants else ():
+        # ranges are served from the file itself
+        if encoding is None and byte_range is None and \
+                request.accept_encodings.quality(ext_encoding) > 0 and \
+                os.path.isfile(full + ext):
+            sent, encoding = path + ext, ext_encoding
+    response = flask.send_file(sent,
+        mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+        cache_timeout=IMMUTABLE_MAX_AGE if immutable else None,
+        conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if variants:
+        response.headers["Vary"] = "Accept-Encoding"
+    if immutable:
+        response.headers["Cache-Control"] = "public, max-age=%d, immutable" \
+            % IMMUTABLE_MAX_AGE
+    response.headers["Accept-Ranges"] = "bytes"
+    if response.status_code == 200 and byte_range is not None:
+        response = _send_range(response, full, byte_range)
+    return response
+
+
+# root path -> (mtime, Precompressor index), see _compressed_index
+_compressed_indexes = {}
+
+def _compressed_index(root):
+    """
+    Returns the index written by Precompressor for root, which maps each
+    compressed file to the digest it had, or {} if there is none.
+    """
+    path = os.path.join(output_state_dir(root), Precompressor.index_name)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+    cached = _compressed_indexes.get(root)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as file_:
+            cached = (mtime, json.loads(file_.read().decode("utf-8")))
+        _compressed_indexes[root] = cached
+    return cached[1]
+
+# (path, mtime, size) -> sha1 of the static files having compressed versions
+_static_digests = {}
+
+def _static_digest(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    digest = _static_digests.get(key)
+    if digest is None:
+        if len(_static_digests) > 4096:
+            _static_digests.clear()
+        digest = _static_digests[key] = file_digest(path)
+    return digest
+
+
+def _single_byte_range(request):
+    """
+    Returns the Range of the request if it asks for a single byte range.
+    Other ranges, multiple or in other units, are not supported, and are
+    ignored as RFC 7233 allows: the full file is sent.
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != "bytes" or \
+            len(byte_range.ranges) != 1:
+        return None
+    return byte_range
+
+
+def _send_range(response, full, byte_range):
+    """
+    Turns the full response for the file at full into the 206 Partial Content
+    response for byte_range, a single byte range, unless the If-Range header
+    of the request does not match the file. A range that cannot be
+    satisfied gives a 416.
+    """
+    if_range = flask.request.if_range
+    if (if_range.etag is not None and
+            if_range.etag != response.get_etag()[0]) or \
+            (if_range.date is not None and
+            if_range.date != response.last_modified):
+        return response
+    size = os.path.getsize(full)
+    byte_range = byte_range.range_for_length(size)
+    response.close()
+    if byte_range is None:
+        response = flask.current_app.response_class(status=416)
+        response.headers["Content-Range"] = "bytes */%d" % size
+        return response
+    start, stop = byte_range
+    file_ = open(full, "rb")
+    file_.seek(start)
+    response.response = _read_file(file_, stop - start)
+    response.status_code = 206
+    response.content_length = stop - start
+    response.headers["Content-Range"] = "bytes %d-%d/%d" \
+        % (start, stop - 1, size)
+    return response
+
+
+def _read_file(file_, length, chunk_size=64 * 1024):
+    try:
+        while length > 0:
+            data = file_.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file_.close()
+
+
+# the content of a tag, where quoted attribute values may contain ">".
+# A quote only starts a value after "=", elsewhere it is a character, like
+# in alt=Don't
+_HTML_TAG_CONTENT = r"""(?:[^>=]|=\s*"[^"]*"|=\s*'[^']*'|=(?!\s*["']))*"""
+
+_HTML_ATTRIBUTE = re.compile(
+    r"""([^\s/>"'=]+)(?:(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>][^\s>]*))?""")
+
+
+class HtmlPostprocessor(object):
+    """
+    A postprocessor running several transforms over a rendered page in a
+    single pass. The page is tokenized once: attribute transforms are called
+    with the values of the attributes they are registered for, text
+    transforms with the text between tags. Comments and the content of
+    script, style, textarea and title elements are never changed.
+    """
+
+    def __init__(self):
+        self._attribute_transforms = {}
+        self._text_transforms = []
+        self._attributes = None
+        self._compile()
+
+    def _compile(self):
+        # a comment, an element whose content is not html, with its
+        # content, or a start tag with its name and attributes. Without
+        # text transforms, only the tags having one of the transformed
+        # attributes are needed, the regular expression skips the others.
+        # With them, end tags and declarations must be told from the text.
+        if self._text_transforms or not self._attribute_transforms:
+            attributes = _HTML_TAG_CONTENT
+            other = r"|</?[a-zA-Z!?]%s>" % _HTML_TAG_CONTENT
+        else:
+            attributes = r"%s?\s(?:%s)\s*(?==)%s" % (_HTML_TAG_CONTENT,
+                "|".join(re.escape(a) for a in self._attribute_transforms),
+                _HTML_TAG_CONTENT)
+            other = ""
+        self._tokens = re.compile(r"<!--.*?-->"
+            r"|<(script|style|textarea|title)\b(%s)>.*?(?:</\1\s*>|\Z)"
+            r"|<([a-zA-Z][^\s/>]*)(%s)>%s" % (_HTML_TAG_CONTENT, attributes,
+            other), re.S | re.I)
+
+    def add_attribute_transform(self, transform, attributes=("href", "src")):
+        """
+        Registers transform(tag, attribute, value), returning the new value
+        of the attribute. value has no quotes and tag and attribute are
+        lowercase.
+        """
+        for attribute in attributes:
+            self._attribute_transforms.setdefault(attribute.lower(),
+                []).append(transform)
+        names = "|".join(re.escape(a) for a in self._attribute_transforms)
+        self._attributes = re.compile(r"(?:^|\s)(%s)\s*=" % names, re.I)
+        self._compile()
+
+    def add_text_transform(self, transform):
+        """
+        Registers transform(text), returning the new text.
+        """
+        self._text_transforms.append(transform)
+        self._compile()
+
+    def iter(self, data):
+        """
+        Yields the chunks of the transformed page. The parts of the page
+        left unchanged are yielded as large slices.
+        """
+        text_transforms = self._text_transforms
+        pos = 0  # the data before pos was yielded
+        last = 0  # the end of the previous token
+        for match in self._tokens.finditer(data):
+            start = match.start()
+            if text_transforms and start > last:
+                yield data[pos:last]
+                yield self._text(data[last:start])
+                pos = start
+            last = match.end()
+            if match.group(1):
+                tag, attributes = match.group(1), match.group(2)
+                end = match.end(2) + 1
+            elif match.group(3):
+                tag, attributes = match.group(3), match.group(4)
+                end = last
+            else:
+                continue
+            new = self._tag(tag, attributes)
+            if new is not None:
+                yield data[pos:start]
+                yield new
+                pos = end
+        if text_transforms and last < len(data):
+            yield data[pos:last]
+            yield self._text(data[last:])
+            pos = len(data)
+        yield data[pos:]
+
+    def __call__(self, data):
+        return "".join(self.iter(data))
+
+    def _text(self, text):
+        for transform in self._text_transforms:
+            text = transform(text)
+        return text
+
+    def _tag(self, tag, attributes):
+        """
+        Returns the start tag with its attributes transformed, None if they
+        are unchanged.
+        """
+        if self._attributes is None or \
+                not self._attributes.search(attributes):
+            return None
+        chunks = ["<", tag]
+        pos = 0
+        changed = False
+        for attribute in _HTML_ATTRIBUTE.finditer(attributes):
+            value = attribute.group(3)
+            name = attribute.group(1).lower()
+            if value is None or name not in self._attribute_transforms:
+                continue
+            quote = value[0] if value[0] in "\"'" else ""
+            old = value[1:-1] if quote else value
+            new = old
+            for transform in self._attribute_transforms[name]:
+                new = transform(tag.lower(), name, new)
+            if new == old:
+                continue
+            changed = True
+            chunks.append(attributes[pos:attribute.start(3)])
+            chunks.append('%s%s%s' % (quote or '"', new, quote or '"'))
+            pos = attribute.end(3)
+        if not changed:
+            return None
+        chunks.append(attributes[pos:])
+        chunks.append(">")
+        return "".join(chunks)
+
+
+_TEMPLATE_LINK = re.compile(r"\.(haml|mako)(?=$|[?#])")
+
+def template_link_to_html(tag, attribute, value):
+    """
+    Attribute transform changing the .haml and .mako extension of a link
+    to .html, as they are generated.
+    """
+    return _TEMPLATE_LINK.sub(".html", value, 1)
+
+
+def default_postprocessor():
+    """
+    The postprocessor used to generate the pages: it changes the links to
+    templates into links to the generated files.
+    """
+    postprocessor = HtmlPostprocessor()
+    postprocessor.add_attribute_transform(template_link_to_html)
+    return postprocessor
+
+
+change_href_to_html = default_postprocessor()
 
 
 def config_to_dict(root_path, config_file):
     config = FlaskConfig(root_path)
-    config.from_pyfile(config_file)
+    if config_file:
+        config.from_pyfile(config_file)
     return dict((k, v) for k, v in config.iteritems())
 
 
+def user_cache_dir():
+    """
+    Returns the folder where pygreen keeps its caches: pygreen in
+    $XDG_CACHE_HOME, ~/.cache by default.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pygreen")
+
+
+def _folder_key(folder):
+    path = os.path.abspath(folder)
+    sha = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return "%s-%s" % (os.path.basename(path) or "root", sha[:12])
+
+
+def site_cache_dir(folder):
+    """
+    Returns the folder of user_cache_dir where the caches of the site in
+    folder are kept, named after its absolute path.
+    """
+    return os.path.join(user_cache_dir(), _folder_key(folder))
+
+
+def output_state_dir(output_folder):
+    """
+    Returns the folder of user_cache_dir where the build manifest and the
+    compression index of a generated site are kept, named after the
+    absolute path of output_folder, so that they are not deployed with it.
+    """
+    return os.path.join(user_cache_dir(), "outputs", _folder_key(output_folder))
+
+
+def _writable_dir(path):
+    """
+    Creates the directory at path if needed, returns False if it cannot be
+    created or written to.
+    """
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    except OSError:
+        # another process may have made it
+        if not os.path.isdir(path):
+            return False
+    return os.access(path, os.W_OK)
+
+
+def _callable_name(func):
+    module = getattr(func, "__module__", None) or ""
+    version = getattr(sys.modules.get(module), "__version__", "")
+    return "%s.%s %s" % (module, getattr(func, "__name__", repr(func)),
+        version)
+
+
+class PreprocessorCache(object):
+    """
+    Keeps the output of a template preprocessor, like the HAML to Mako
+    conversion, in directory. Entries are named after a hash of the
+    preprocessor and of its input, so the processes compiling the same
+    templates share them, and run the preprocessor once per version of a
+    template.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, preprocessor, text):
+        """
+        The file where the output of preprocessor for text is kept.
+        """
+        sha = hashlib.sha1(_callable_name(preprocessor).encode("utf-8") +
+            b"\0" + text.encode("utf-8"))
+        return os.path.join(self.directory, sha.hexdigest() + ".mako")
+
+    def run(self, preprocessor, text):
+        path = self.path(preprocessor, text)
+        try:
+            with io.open(path, "r", encoding="utf-8") as file_:
+                result = file_.read()
+            self.hits += 1
+            return result
+        except IOError:
+            pass
+        self.misses += 1
+        result = preprocessor(text)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            write_if_changed(path, result.encode("utf-8"))
+        except OSError:
+            # another process may have made it, or the cache is read-only
+            pass
+        return result
+
+    def wrap(self, preprocessor):
+        def cached(text):
+            return self.run(preprocessor, text)
+        cached.__name__ = preprocessor.__name__
+        cached.__module__ = preprocessor.__module__
+        return cached
+
+
 class PolyLexer(Lexer):
     """
-    Supports transparent preprocessing of .haml templates
+    Supports transparent preprocessing of .haml templates. The chain of
+    preprocessors is built once per lexer: the HAML conversion for .haml
+    files, then the preprocessors of the lookup. The HAML conversions are
+    kept in cache, a PreprocessorCache, if set; see with_cache.
+    """
+
+    cache = None
+
+    def __init__(self, *args, **kwargs):
+        super(PolyLexer, self).__init__(*args, **kwargs)
+        # a list given by the lookup is shared by every template
+        self.preprocessor = self.chain(self.filename, self.preprocessor)
+
+    @classmethod
+    def chain(cls, filename, preprocessors):
+        """
+        Returns the preprocessors run on the source of the template file.
+        """
+        chain = list(preprocessors)
+        if filename and os.path.splitext(filename)[1] == ".haml":
+            import haml
+            if haml.preprocessor not in chain:
+                chain.insert(0, haml.preprocessor)
+        # only imported if used, by the lookup or just above
+        haml = sys.modules.get("haml")
+        if cls.cache is not None and haml is not None:
+            chain = [cls.cache.wrap(p) if p is haml.preprocessor else p
+                for p in chain]
+        return chain
+
+    @classmethod
+    def with_cache(cls, cache):
+        """
+        Returns a subclass keeping its HAML conversions in cache.
+        """
+        return type(str("Cached%s" % cls.__name__), (cls,), {"cache": cache})
+
+
+class CountingTemplateLookup(TemplateLookup):
+    """
+    TemplateLookup that counts how many times a template was found in its
+    collection (hits) and how many times it had to be loaded (misses).
+    loads lists the uri of each loaded template with the seconds spent
+    loading, and if needed compiling, it.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingTemplateLookup, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+        self.loads = []
+
+    def get_template(self, uri):
+        if uri in self._collection:
+            self.hits += 1
+            return super(CountingTemplateLookup, self).get_template(uri)
+        self.misses += 1
+        before = time.time()
+        try:
+            return super(CountingTemplateLookup, self).get_template(uri)
+        finally:
+            self.loads.append((uri, time.time() - before))
+
+    def has_template(self, uri):
+        # the one of TemplateLookup loads the template with get_template,
+        # which would count each render twice
+        if uri in self._collection:
+            return True
+        u = re.sub(r'^\/+', '', uri)
+        return any(os.path.isfile(posixpath.normpath(posixpath.join(d, u)))
+            for d in self.directories)
+
+
+# calls in the code generated by Mako for <%inherit>, <%include> and
+# <%namespace file="...">, the group is the expression giving the uri
+_DEPENDENCY_PATTERNS = [
+    re.compile(r"runtime\._inherit_from\(context, (.+?), _template_uri\)"),
+    re.compile(r"runtime\._include_file\(context, (.+?), _template_uri"),
+    re.compile(r"TemplateNamespace\(.*?, templateuri=(.+?), callables="),
+]
+
+def _uncounted_template(lookup, uri):
+    # the lookups of a CountingTemplateLookup count the renders
+    return TemplateLookup.get_template(lookup, uri)
+
+
+def template_dependencies(lookup, uri):
+    """
+    Returns the set of filenames of the templates that the template at uri
+    inherits, includes or uses as a namespace, directly or through another
+    template. They are read from the compiled modules, so .haml templates
+    are seen after their conversion by PolyLexer. Returns None when one of
+    the uris is an expression that is only known when rendering.
+    """
+    filenames = set()
+    seen = set([uri])
+    pending = [_uncounted_template(lookup, uri)]
+    while pending:
+        template = pending.pop()
+        for pattern in _DEPENDENCY_PATTERNS:
+            for match in pattern.finditer(template.code):
+                try:
+                    dep = ast.literal_eval(match.group(1))
+                except (ValueError, SyntaxError):
+                    return None
+                dep_uri = lookup.adjust_uri(dep, template.uri)
+                if dep_uri not in seen:
+                    seen.add(dep_uri)
+                    dep_template = _uncounted_template(lookup, dep_uri)
+                    filenames.add(dep_template.filename)
+                    pending.append(dep_template)
+    return filenames
+
+
+def shard_of(output, count):
+    """
+    Returns the shard, from 0 to count - 1, of an output path. It only
+    depends on the path, so every machine puts a file in the same shard,
+    and the shards get about as many files each.
+    """
+    digest = hashlib.sha1(output.encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % count
+
+
+def merge_shards(output_folder, shard_folders, sync=False):
+    """
+    Combines the output folders of the shards of a generation into
+    output_folder: their files are copied, and their build manifests and
+    compression indexes merged, so that output_folder can be generated
+    incrementally afterwards. With sync, the files of output_folder that
+    are in none of the shards are deleted. Returns the number of files
+    copied.
+    """
+    manifest = BuildManifest(".", output_folder)
+    manifest.outputs, manifest.digests = {}, {}
+    compressed = {}
+    owners = {}
+    for shard in shard_folders:
+        part = BuildManifest(".", shard)
+        manifest.outputs.update(part.outputs)
+        manifest.digests.update(part.digests)
+        index = os.path.join(output_state_dir(shard), Precompressor.index_name)
+        if os.path.exists(index):
+            with open(index, "rb") as file_:
+                compressed.update(json.loads(file_.read().decode("utf-8")))
+        for dirpath, dirnames, filenames in os.walk(shard):
+            for name in filenames:
+                relpath = os.path.relpath(os.path.join(dirpath, name), shard)
+                if relpath in owners:
+                    raise ValueError("%s is in both %s and %s, were they "
+                        "generated with the same shard count?"
+                        % (relpath, owners[relpath], shard))
+                owners[relpath] = shard
+    for relpath, shard in sorted(owners.items()):
+        dest = os.path.join(output_folder, relpath)
+        d = os.path.dirname(dest)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        shutil.copy2(os.path.join(shard, relpath), dest)
+    manifest.save()
+    if compressed:
+        with open(os.path.join(output_state_dir(output_folder),
+                Precompressor.index_name), "wb") as file_:
+            file_.write(json.dumps(compressed, sort_keys=True).encode("utf-8"))
+    deleted = 0
+    if sync:
+        deleted = delete_orphans(output_folder, owners)
+    _logger.info("%d files merged from %d shards, %d deleted"
+        % (len(owners), len(shard_folders), deleted))
+    return len(owners)
+
+
+class BuildManifest(object):
+    """
+    Remembers, for each file of a generated site, the hashes of the files it
+    was made from, so that the next incremental generation only renders the
+    files whose sources changed. It is stored as json in
+    output_state_dir(output_folder).
+    """
+
+    name = "manifest.json"
+    version = 1
+
+    def __init__(self, folder, output_folder):
+        self.folder = folder
+        self.path = os.path.join(output_state_dir(output_folder), self.name)
+        self.output_folder = output_folder
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file_:
+                data = json.loads(file_.read().decode("utf-8"))
+            if data.get("version") != self.version:
+                data = {}
+        # relative path -> [mtime, size, sha1], to avoid hashing files
+        # that did not change since the last run
+        self.digests = data.get("digests", {})
+        # output path -> {"source", "context", "sources"}
+        self.outputs = data.get("outputs", {})
+
+    def digest(self, relpath):
+        """
+        Returns the sha1 of a file relative to the site folder, or None if it
+        does not exist.
+        """
+        try:
+            st = os.stat(os.path.join(self.folder, relpath))
+        except OSError:
+            self.digests.pop(relpath, None)
+            return None
+        known = self.digests.get(relpath)
+        if known and known[0] == st.st_mtime and known[1] == st.st_size:
+            return known[2]
+        digest = file_digest(os.path.join(self.folder, relpath))
+        self.digests[relpath] = [st.st_mtime, st.st_size, digest]
+        return digest
+
+    def is_fresh(self, output, source, context):
+        entry = self.outputs.get(output)
+        if entry is None or entry["source"] != source or \
+                entry["sources"] is None:
+            return False
+        if entry["context"] is not None and entry["context"] != context:
+            return False
+        if not os.path.exists(os.path.join(self.output_folder, output)):
+            return False
+        for relpath, digest in entry["sources"].items():
+            if self.digest(relpath) != digest:
+                return False
+        return True
+
+    def record(self, output, source, dependencies, context):
+        """
+        Records an output generated from source. dependencies is the list of
+        other files it was made from, or None if it is not known. context is
+        the digest of the render context for templates, None for files
+        copied as they are.
+        """
+        sources = None
+        if dependencies is not None:
+            sources = dict((relpath, self.digest(relpath))
+                for relpath in [source] + list(dependencies))
+        self.outputs[output] = {"source": source, "context": context,
+            "sources": sources}
+
+    def retain(self, outputs):
+        """
+        Forgets the outputs that are not in outputs anymore.
+        """
+        outputs = set(outputs)
+        for output in list(self.outputs):
+            if output not in outputs:
+                del self.outputs[output]
+
+    def sources(self):
+        """
+        Returns the set of the files, relative to the site folder, that the
+        outputs were made from.
+        """
+        used = set()
+        for entry in self.outputs.values():
+            used.update(entry["sources"] or ())
+        return used
+
+    def save(self):
+        d = os.path.dirname(self.path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        used = self.sources()
+        digests = dict((relpath, digest)
+            for relpath, digest in self.digests.items() if relpath in used)
+        data = {"version": self.version, "digests": digests,
+            "outputs": self.outputs}
+        with open(self.path, "wb") as file_:
+            file_.write(json.dumps(data, sort_keys=True).encode("utf-8"))
+        # it used to be kept, and deployed, in the output folder
+        legacy = os.path.join(self.output_folder, ".pygreen-manifest.json")
+        if os.path.exists(legacy):
+            os.remove(legacy)
+
+
+class TreeLister(object):
+    """
+    Lists the files of a folder that are in an allowed directory and whose
+    path relative to the folder is not matched by an exclusion pattern.
+    Directories that cannot contain such files are not descended into, and
+    the content of each directory is kept with its mtime in cache_file, so
+    that later listings only read the directories that changed.
+    """
+
+    allowed = set(("static", "templates"))
+    disallowed = set(("includes", "layouts"))
+
+    def __init__(self, folder, exclusions, cache_file=None,
+            directory_exclusion=()):
+        self.folder = folder
+        self.exclusion = re.compile("|".join("(?:%s)" % ex
+            for ex in exclusions)) if exclusions else None
+        # a pattern matching a directory path followed by a slash matches
+        # the path of every file below it, unless it looks past what it
+        # consumed
+        self.prune_excluded = self.exclusion is not None and \
+            not re.search(r"\$|\\[ZbB]|\(\?<?[=!]", self.exclusion.pattern)
+        self.cache_file = cache_file
+        self.directory_exclusion = set(directory_exclusion)
+        self.folder_parts = set(pathlib.Path(folder).parts)
+
+    def is_public(self, path):
+        return self.exclusion is None or not self.exclusion.match(path)
+
+    def _load_cache(self):
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, "rb") as file_:
+                    data = json.loads(file_.read().decode("utf-8"))
+                if data.get("folder") == os.path.abspath(self.folder):
+                    return data["dirs"]
+            except (ValueError, KeyError):
+                pass
+        return {}
+
+    def _save_cache(self, dirs):
+        if not self.cache_file:
+            return
+        data = {"folder": os.path.abspath(self.folder), "dirs": dirs}
+        try:
+            d = os.path.dirname(self.cache_file)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            write_if_changed(self.cache_file,
+                json.dumps(data).encode("utf-8"))
+        except (IOError, OSError):
+            # another process may have made it, or the cache is read-only
+            pass
+
+    def list(self):
+        cache = self._load_cache()
+        dirs = {}
+        files = []
+        pending = [""]
+        while pending:
+            rel = pending.pop()
+            path = os.path.join(self.folder, rel)
+            try:
+                mtime = os.stat(path).st_mtime
+                cached = cache.get(rel)
+                if cached and cached[0] == mtime:
+                    subdirs, names = cached[1], cached[2]
+                else:
+                    subdirs, names = _scan(path)
+            except OSError:
+                continue
+            dirs[rel] = [mtime, subdirs, names]
+            parts = self.folder_parts | set(pathlib.Path(rel).parts)
+            if parts & self.disallowed:
+                continue
+            if parts & self.allowed:
+                for name in names:
+                    p = os.path.join(rel, name)
+                    if self.is_public(p):
+                        files.append(p)
+            for name in subdirs:
+                p = os.path.join(rel, name)
+                if name in self.directory_exclusion or (self.prune_excluded
+                        and self.exclusion.match(p + "/")):
+                    continue
+                pending.append(p)
+        self._save_cache(dirs)
+        return sorted(files)
+
+
+def _scan(path):
+    """
+    Returns the names of the subdirectories to descend into and of the other
+    entries of a directory, like os.walk does.
+    """
+    subdirs, names = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+            else:
+                names.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            p = os.path.join(path, name)
+            if os.path.isdir(p):
+                if not os.path.islink(p):
+                    subdirs.append(name)
+            else:
+                names.append(name)
+    return sorted(subdirs), sorted(names)
+
+
+def _csv_records(file_, offset=None):
+    """
+    Yields the offset and the dict of each row of a CSV file with a header
+    row, starting at offset if given. Rows may span several lines.
+    """
+    state = {"pos": file_.tell()}
+    def lines():
+        for line in iter(file_.readline, b""):
+            state["pos"] += len(line)
+            yield line
+    # the reader only pulls the lines of the row it returns, so the
+    # position before each call is where the row starts
+    reader = csv.reader(lines())
+    header = [h.decode("utf-8-sig") for h in next(reader, [])]
+    if offset is not None:
+        file_.seek(offset)
+        state["pos"] = offset
+    while True:
+        start = state["pos"]
+        row = next(reader, None)
+        if row is None:
+            return
+        if row:
+            yield start, dict(zip(header, [v.decode("utf-8") for v in row]))
+
+def _json_records(file_, offset=None):
+    """
+    Yields the offset and the object of each line of a JSON lines file.
+    """
+    if offset is not None:
+        file_.seek(offset)
+    pos = file_.tell()
+    for line in iter(file_.readline, b""):
+        start, pos = pos, pos + len(line)
+        if line.strip():
+            yield start, json.loads(line.decode("utf-8"))
+
+def _yaml_records(file_, offset=None):
+    """
+    Yields the offset and the content of each document of a YAML file, the
+    documents being separated by lines holding only --- or ...
+    """
+    import yaml
+    if offset is not None:
+        file_.seek(offset)
+    pos = file_.tell()
+    start, lines = pos, []
+    for line in iter(file_.readline, b""):
+        marker = line.rstrip()
+        if marker in (b"---", b"...") and lines:
+            record = yaml.safe_load(b"".join(lines))
+            if record is not None:
+                yield start, record
+            start, lines = pos, []
+        pos += len(line)
+        if marker == b"...":
+            # the end of a document, the next one starts after it
+            start = pos
+        else:
+            lines.append(line)
+    if lines:
+        record = yaml.safe_load(b"".join(lines))
+        if record is not None:
+            yield start, record
+
+# the functions reading the records of a dataset, by extension
+DATA_READERS = {
+    ".csv": _csv_records,
+    ".json": _json_records,
+    ".jsonl": _json_records,
+    ".yml": _yaml_records,
+    ".yaml": _yaml_records,
+}
+
+
+class DataRoute(object):
+    """
+    Pages rendered from one template for each record of a dataset: a CSV
+    file with a header row, a JSON file with one object per line, or a YAML
+    file with one document per record. The path of each page is pattern
+    formatted with the record, like "catalog/{sku}.html", and the template
+    gets the record as record, besides the usual variables. Keep the
+    template in a folder that is not listed, like templates/includes.
+
+    The dataset is read as a stream: only the offset of each record in the
+    file is kept, to read the record again when its page is rendered.
+    """
+
+    def __init__(self, green, dataset, template, pattern):
+        self.green = green
+        # relative to the folder of green
+        self.dataset = dataset
+        self.template = template
+        self.pattern = pattern
+        ext = os.path.splitext(dataset)[1].lower()
+        if ext not in DATA_READERS:
+            raise ValueError("unknown dataset format: %s" % dataset)
+        self.reader = DATA_READERS[ext]
+        # what the paths of the pages start and end with, to tell the
+        # other paths without reading the dataset
+        literal = pattern.split("{", 1)[0]
+        directory = posixpath.normpath(posixpath.dirname(literal))
+        self._prefix = "" if directory in (".", "") else directory + "/"
+        self._suffix = pattern.rsplit("}", 1)[-1] if "}" in pattern else ""
+        # (mtime, size) of the dataset, {path: offset}
+        self._index = None
+
+    def _path(self):
+        return os.path.join(self.green.folder, self.dataset)
+
+    def _stat(self):
+        st = os.stat(self._path())
+        return st.st_mtime, st.st_size
+
+    def _build_index(self):
+        key = self._stat()
+        offsets = {}
+        with open(self._path(), "rb") as file_:
+            for offset, record in self.reader(file_):
+                path = posixpath.normpath(self.pattern.format(**record))
+                if path.startswith(("/", "../")) or path == "..":
+                    _logger.warning("%s: %s is outside the site, skipped"
+                        % (self.dataset, path))
+                elif path in offsets:
+                    _logger.warning("%s: two records give %s, the first one "
+                        "is used" % (self.dataset, path))
+                else:
+                    offsets[path] = offset
+        self._index = (key, offsets)
+        return offsets
+
+    def offsets(self):
+        """
+        Maps the path of each page to the offset of its record, reading the
+        dataset again if it changed.
+        """
+        if self._index is None or self._index[0] != self._stat():
+            return self._build_index()
+        return self._index[1]
+
+    def list(self):
+        """
+        The paths of the pages, a file lister.
+        """
+        return sorted(self._build_index())
+
+    def _offset(self, path):
+        """
+        Returns the offset of the record of the page at path, or None if it
+        is not one of the pages of the route or the dataset is missing.
+        """
+        if not path.startswith(self._prefix) or \
+                not path.endswith(self._suffix):
+            return None
+        try:
+            return self.offsets().get(path)
+        except (IOError, OSError) as e:
+            _logger.warning("%s: %s" % (self.dataset, e))
+            return None
+
+    def has_page(self, path):
+        """
+        Returns whether path is one of the pages of the route.
+        """
+        return self._offset(path) is not None
+
+    def record(self, path):
+        """
+        Returns the record of the page at path, or None if it is not one of
+        the pages of the route.
+        """
+        offset = self._offset(path)
+        if offset is None:
+            return None
+        try:
+            with open(self._path(), "rb") as file_:
+                for _, record in self.reader(file_, offset):
+                    return record
+        except (IOError, OSError) as e:
+            # removed since the offsets were read
+            _logger.warning("%s: %s" % (self.dataset, e))
+            return None
+
+    def dependencies(self):
+        """
+        Paths, relative to the folder, of the files the pages are made of,
+        or None if they are not known.
+        """
+        templates = self.green.templates
+        filenames = template_dependencies(templates, self.template)
+        if filenames is None:
+            return None
+        filenames.add(_uncounted_template(templates, self.template).filename)
+        return sorted([self.dataset] + [os.path.relpath(f, self.green.folder)
+            for f in filenames])
+
+
+class ResponseCache(object):
+    """
+    A size-bounded LRU cache of rendered templates, used by the web server.
+    Each entry remembers the modification times of the template files it was
+    rendered from and the key of the render context, and is dropped when one
+    of them changed.
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        # maximum total size of the cached bodies, in bytes
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, context_key):
+        """
+        Returns the (body, etag) cached for key if it is still valid.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry["context"] == context_key and \
+                        _mtimes(entry["files"]) == entry["mtimes"]:
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry["body"], entry["etag"]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, context_key, files, body):
+        """
+        Caches the body rendered for key from the template files. Returns
+        the strong ETag of the body.
+        """
+        etag = hashlib.sha1(body).hexdigest()
+        if len(body) > self.max_size:
+            return etag
+        with self._lock:
+            self._remove(key)
+            while self._entries and self.size + len(body) > self.max_size:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = {"context": context_key, "files": files,
+                "mtimes": _mtimes(files), "body": body, "etag": etag}
+            self.size += len(body)
+        return etag
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry["body"])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries), "size": self.size}
+
+
+def _mtimes(files):
+    mtimes = []
+    for f in files:
+        try:
+            mtimes.append(os.stat(f).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+# types of the files worth compressing
+COMPRESSIBLE_TYPES = set([
+    "text/html", "text/css", "text/plain", "text/xml", "text/javascript",
+    "application/javascript", "application/x-javascript", "application/json",
+    "application/xml", "application/rss+xml", "application/atom+xml",
+    "image/svg+xml",
+])
+
+class Precompressor(object):
+    """
+    Writes compressed versions (.gz, .br) next to the files of a generated
+    site, so that web servers do not have to compress them for each
+    request. Only the files of a type in types and of at least min_size
+    bytes are compressed. The digest of each compressed file is kept in
+    output_state_dir(output_folder), and files whose bytes did not change
+    are not compressed again.
+    """
+
+    index_name = "compressed.json"
+
+    def __init__(self, output_folder, encodings=("gzip", "br"), min_size=1024,
+            types=COMPRESSIBLE_TYPES, jobs=1):
+        self.output_folder = output_folder
+        known = [encoding for encoding, ext in PRECOMPRESSED_ENCODINGS]
+        for encoding in encodings:
+            if encoding not in known:
+                raise ValueError("unknown encoding %s" % encoding)
+        self.encodings = [e for e in encodings if e != "br" or brotli]
+        if len(self.encodings) != len(encodings):
+            _logger.warning("brotli is not installed, .br files are not written")
+        self.min_size = min_size
+        self.types = types
+        self.jobs = jobs
+        self.index_path = os.path.join(output_state_dir(output_folder),
+            self.index_name)
+
+    def run(self, outputs):
+        """
+        Compresses the outputs, paths relative to the output folder. Returns
+        the number of files compressed.
+        """
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as file_:
+                index = json.loads(file_.read().decode("utf-8"))
+        tasks = [(self.output_folder, output, self.encodings, self.min_size,
+            index.get(output)) for output in outputs
+            if mimetypes.guess_type(output)[0] in self.types]
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                results = pool.map(_compress_output, tasks,
+                    max(1, len(tasks) // (self.jobs * 4)))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [_compress_output(task) for task in tasks]
+        compressed = 0
+        for (_, output, _, _, previous), digest in zip(tasks, results):
+            if digest is None:
+                index.pop(output, None)
+            else:
+                index[output] = digest
+                compressed += digest != previous
+        d = os.path.dirname(self.index_path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(self.index_path, "wb") as file_:
+            file_.write(json.dumps(index, sort_keys=True).encode("utf-8"))
+        # it used to be kept, and deployed, in the output folder
+        legacy = os.path.join(self.output_folder, ".pygreen-compressed.json")
+        if os.path.exists(legacy):
+            os.remove(legacy)
+        _logger.info("compressed %d files" % compressed)
+        return compressed
+
+
+def _compress_output(task):
+    """
+    Writes the compressed versions of a file unless its digest is previous
+    and they exist. Returns the digest of the file, or None if it is too
+    small to be compressed.
+    """
+    output_folder, output, encodings, min_size, previous = task
+    path = os.path.join(output_folder, output)
+    with open(path, "rb") as file_:
+        data = file_.read()
+    targets = [(encoding, path + ext)
+        for encoding, ext in PRECOMPRESSED_ENCODINGS if encoding in encodings]
+    if len(data) < min_size:
+        for encoding, target in targets:
+            if os.path.exists(target):
+                os.remove(target)
+        return None
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == previous and \
+            all(os.path.exists(target) for _, target in targets):
+        # touch them so that they stay more recent than the file
+        for _, target in targets:
+            os.utime(target, None)
+        return digest
+    for encoding, target in targets:
+        if encoding == "gzip":
+            buf = io.BytesIO()
+            # no name and a fixed mtime keep the output reproducible
+            with gzip.GzipFile(filename="", mode="wb", compresslevel=9,
+                    fileobj=buf, mtime=0) as gz:
+                gz.write(data)
+            compressed = buf.getvalue()
+        else:
+            compressed = brotli.compress(data)
+        with open(target, "wb") as file_:
+            file_.write(compressed)
+    return digest
+
+
+def write_if_changed(path, content):
+    """
+    Writes content into path, unless path already holds it. The content is
+    written into a temporary file renamed to path, so that path is never
+    seen partially written. Returns whether path was written.
+    """
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, "rb") as file_:
+                if file_.read() == content:
+                    return False
+    except (IOError, OSError):
+        pass
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(prefix=".%s." % name, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as file_:
+            file_.write(content)
+        os.chmod(temp, 0o666 & ~_UMASK)
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+    return True
+
+
+def _umask():
+    # the umask can only be read by setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# read once: a thread creating a file while it is 0 would get a file
+# writable by everyone
+_UMASK = _umask()
+
+
+def delete_orphans(folder, keep, owned=None):
+    """
+    Deletes the files of folder whose path relative to folder is not in
+    keep, then the directories left empty. Hidden files and directories
+    are left alone, and so are the files for which owned(relpath), if
+    given, is false. Returns the number of files deleted.
     """
-    def parse(self):
-        fname, ext = os.path.splitext(self.filename)
-        if ext == ".haml":
-            self.preprocessor.insert(0, haml.preprocessor)
-        return super(PolyLexer, self).parse()
+    deleted = 0
+    for dirpath, dirnames, filenames in os.walk(folder, topdown=False):
+        if any(part.startswith(".") for part in
+                os.path.relpath(dirpath, folder).split(os.sep)
+                if part != "."):
+            continue
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, folder)
+            if name.startswith(".") or relpath in keep or \
+                    (owned is not None and not owned(relpath)):
+                continue
+            os.remove(path)
+            deleted += 1
+        if dirpath != folder and not os.listdir(dirpath):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # another shard wrote into it, or removed it
+                pass
+    return deleted
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+@contextmanager
+def _no_phase(name):
+    yield
+
+
+class GenProfiler(object):
+    """
+    Records the wall and CPU time gen_static spends in each phase (listing,
+    asset builds, rendering...) and on each file, split in steps: render
+    (which includes loading the templates), postprocess and write. The time
+    spent loading each template and the template cache hits and misses are
+    recorded too.
+    If profile_path is given, the generation of that file is run under
+    cProfile and the stats are dumped into profile_output.
+    """
+
+    def __init__(self, profile_path=None, profile_output=None):
+        self.phases = {}
+        self.files = {}
+        self.profile_path = profile_path
+        self.profile_output = profile_output
+        self._file = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a phase, or a step of the file being generated.
+        """
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield
+        finally:
+            if self._file is not None:
+                self._file[name] = self._file.get(name, 0) + \
+                    time.time() - wall
+            else:
+                times = self.phases.setdefault(name, {"wall": 0, "cpu": 0})
+                times["wall"] += time.time() - wall
+                times["cpu"] += _cpu_time() - cpu
+
+    def timed(self, name, func):
+        """
+        Wraps func so that its calls are timed as the phase name.
+        """
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def file(self, path, lookup):
+        """
+        Times the generation of path, lookup being the CountingTemplateLookup
+        used to render it.
+        """
+        entry = self._file = {}
+        hits, misses, loads = lookup.hits, lookup.misses, len(lookup.loads)
+        profile = None
+        if path == self.profile_path:
+            profile = cProfile.Profile()
+            profile.enable()
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield
+        finally:
+            entry["wall"] = time.time() - wall
+            entry["cpu"] = _cpu_time() - cpu
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.profile_output)
+            entry["template_hits"] = lookup.hits - hits
+            entry["template_misses"] = lookup.misses - misses
+            entry["template_loads"] = lookup.loads[loads:]
+            self.files[path] = entry
+            self._file = None
+
+    def report(self):
+        """
+        Returns the report as a dict that can be dumped as JSON.
+        """
+        steps = {}
+        templates = {}
+        hits = misses = 0
+        for path, entry in self.files.items():
+            for name, seconds in entry.items():
+                if name not in ("wall", "cpu") and \
+                        not name.startswith("template_"):
+                    steps[name] = steps.get(name, 0) + seconds
+            for uri, seconds in entry["template_loads"]:
+                templates[uri] = templates.get(uri, 0) + seconds
+            hits += entry["template_hits"]
+            misses += entry["template_misses"]
+        files = dict((path, dict((k, v) for k, v in entry.items()
+            if not k.startswith("template_")))
+            for path, entry in self.files.items())
+        return {
+            "phases": self.phases,
+            "steps": steps,
+            "files": files,
+            "templates": templates,
+            "template_hits": hits,
+            "template_misses": misses,
+        }
+
+    def save(self, path, extra=None):
+        """
+        Writes the report as JSON into path, with the items of extra.
+        """
+        report = self.report()
+        report.update(extra or {})
+        with open(path, "wb") as file_:
+            file_.write(json.dumps(report, indent=2,
+                sort_keys=True).encode("utf-8"))
+
+    def log_summary(self, count=10):
+        """
+        Logs the time spent in each phase, and the count slowest files and
+        templates.
+        """
+        report = self.report()
+        for name, times in sorted(report["phases"].items(),
+                key=lambda item: -item[1]["wall"]):
+            _logger.info("%-12s %8.3fs wall %8.3fs cpu"
+                % (name, times["wall"], times["cpu"]))
+        for name, seconds in sorted(report["steps"].items(),
+                key=lambda item: -item[1]):
+            _logger.info("  %-10s %8.3fs" % (name, seconds))
+        _logger.info("slowest files:")
+        for path, entry in sorted(report["files"].items(),
+                key=lambda item: -item[1]["wall"])[:count]:
+            _logger.info("%8.3fs %s" % (entry["wall"], path))
+        _logger.info("slowest templates to load:")
+        for uri, seconds in sorted(report["templates"].items(),
+                key=lambda item: -item[1])[:count]:
+            _logger.info("%8.3fs %s" % (seconds, uri))
+        _logger.info("templates: %d hits, %d misses"
+            % (report["template_hits"], report["template_misses"]))
+
+
+def file_digest(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
 class PyGreen(object):
@@ -100,13 +1579,46 @@ class PyGreen(object):
         # directly, use set_folder instead
         self.folder = "."
 
-        # Process templates at instantiation
-        self.templates = self._get_templates()
+        # the config file passed to Flask and to the templates
+        self.config_file = None
+
+        # the folder, relative to the site folder, where compiled templates
+        # and other caches are stored, or a function returning it for the
+        # site folder. The default is outside of the site, see
+        # site_cache_dir. None disables the caches on disk.
+        self.cache_dir = site_cache_dir
+
+        # the number of compiled templates kept in memory
+        self.template_cache_size = 100
+
+        # the preprocessors run on every template, see set_preprocessor
+        self.preprocessors = []
+
+        # the config dict and asset urls given to templates, with the key
+        # telling when they must be computed again. See render_context.
+        self._render_context = None
+
+        # how many times the render context was computed
+        self.render_context_computations = 0
+
+        # the ResponseCache of the web server, None to disable it
+        self.response_cache = ResponseCache()
+
+        # the TemplateLookup and the AssetManager, built on first use, see
+        # the templates and manager properties
+        self._templates = None
+        self._manager = None
 
         # Set production to false as a default
         self.production = False
 
-        self.manager = self._setup_manager()
+        # the number of asset bundles built at the same time, None for one
+        # per CPU
+        self.asset_jobs = None
+
+        # the maximum size in bytes of the cache of the asset filters and
+        # bundles, kept across runs, 0 to disable it
+        self.asset_cache_size = 64 * 1024 * 1024
 
         # A list of regular expression. Files whose the name match
         # one of those regular expressions will not be outputed when generating
@@ -117,30 +1629,18 @@ class PyGreen(object):
             r".*\.webassets-cache"
         ]
 
-        # Support additional directories by
-        # only accepting these on static page generation
-        def dirpath_allowed(dirpath):
-            allowed = set(("static", "templates"))
-            disallowed = set(("includes", "layouts"))
-            parts = set(pathlib.Path(dirpath).parts)
-            return (parts & allowed) and not (parts & disallowed)
+        # Names of directories that are never searched for files to
+        # generate, like node_modules
+        self.directory_exclusion = []
 
+        # Support additional directories by
+        # only accepting these on static page generation,
+        # see TreeLister
         def is_public(path):
-            for ex in self.file_exclusion:
-                if re.match(ex, path):
-                    return False
-            return True
+            return self._lister().is_public(path)
 
         def base_lister():
-            files = []
-            for dirpath, dirnames, filenames in os.walk(self.folder):
-                if dirpath_allowed(dirpath):
-                    for f in filenames:
-                        absp = os.path.join(dirpath, f)
-                        path = os.path.relpath(absp, self.folder)
-                        if is_public(path):
-                            files.append(path)
-            return files
+            return self._lister().list()
 
         # A list of functions. Each function must return a list of paths
         # of files to export during the generation of the static web site.
@@ -150,79 +1650,457 @@ class PyGreen(object):
         # will not be able to detect the files to export.
         self.file_listers = [base_lister]
 
+        # The DataRoutes of the site, see add_data_route
+        self.data_routes = []
+
         def file_renderer(path, postprocessor=None):
+            for route in self.data_routes:
+                record = route.record(path)
+                if record is not None:
+                    return self._render_template(route.template,
+                        postprocessor, record=record)
             if is_public(path):
+                # the pages of a generated site, compressed by Precompressor,
+                # are sent with their compressed versions
                 if path.split(".")[-1] in self.template_exts and \
+                        path not in _compressed_index(self.folder) and \
                         self.templates.has_template(path):
-                    t = self.templates.get_template(path)
-                    data = t.render_unicode(pygreen=self,
-                        config=config_to_dict(self.folder, self.config_file),
-                        asset_urls=self.manager.asset_urls())
-                    if callable(postprocessor):
-                        data = postprocessor(data)
-                    try:
-                        return data.encode(t.module._source_encoding)
-                    except:
-                        return data
+                    return self._render_template(path, postprocessor)
                 if os.path.exists(os.path.join(self.folder, path)):
-                    return flask.send_file(path)
+                    return self.send_static(path)
             flask.abort(404)
 
+        # The HtmlPostprocessor applied to the pages by get and gen_static,
+        # more transforms can be added to it
+        self.postprocessor = default_postprocessor()
+
         # The default function used to render files. Could be modified to change the way files are
         # generated, like using another template language or transforming css...
         self.file_renderer = file_renderer
 
+    def _render_template(self, uri, postprocessor=None, **kwargs):
+        """
+        Renders the template at uri with the render context and kwargs.
+        """
+        t = self.templates.get_template(uri)
+        config, asset_urls = self.render_context()
+        data = t.render_unicode(pygreen=self, config=dict(config),
+            asset_urls=asset_urls, **kwargs)
+        if callable(postprocessor):
+            data = postprocessor(data)
+        try:
+            return data.encode(t.module._source_encoding)
+        except:
+            return data
+
+    def add_data_route(self, dataset, template, pattern):
+        """
+        Renders template once for each record of dataset, at the path given
+        by pattern, when serving and generating the site. See DataRoute.
+        """
+        route = DataRoute(self, dataset, template, pattern)
+        self.data_routes.append(route)
+        self.file_listers.append(route.list)
+        return route
+
     def set_folder(self, folder):
         """
         Sets the folder where the files to serve are located.
         """
         self.folder = folder
-        self.templates.directories[0] = folder
-        self.templates.directories[1] = os.path.join(folder, 'templates')
+        if self._templates is not None:
+            self._templates.directories[0] = folder
+            self._templates.directories[1] = os.path.join(folder, 'templates')
+
+    @property
+    def templates(self):
+        """
+        The TemplateLookup of the templates of the site.
+        """
+        if self._templates is None:
+            self._templates = self._get_templates()
+        return self._templates
+
+    @templates.setter
+    def templates(self, templates):
+        self._templates = templates
+
+    @property
+    def manager(self):
+        """
+        The AssetManager of the site. It reads assets.yml, so it is only
+        built when needed, and once for each set_production.
+        """
+        if self._manager is None:
+            self._manager = self._setup_manager()
+        return self._manager
+
+    @manager.setter
+    def manager(self, manager):
+        self._manager = manager
 
     def _get_templates(self):
         template_dir = os.path.join(self.folder, 'templates')
-        return TemplateLookup(directories=[self.folder, template_dir],
+        return CountingTemplateLookup(directories=[self.folder, template_dir],
             imports=["from markdown import markdown",
-                     "from filters import smartydown, sectionize"],
+                     "from filters import smartydown, smartydown_many, sectionize"],
             input_encoding='iso-8859-1',
-            collection_size=100,
-            lexer_cls=PolyLexer
+            collection_size=self.template_cache_size,
+            modulename_callable=self._template_module_path,
+            preprocessor=list(self.preprocessors),
+            lexer_cls=self._lexer_cls()
         )
 
+    def _lexer_cls(self):
+        cache = self._cache_path("haml")
+        if cache is None:
+            return PolyLexer
+        return PolyLexer.with_cache(PreprocessorCache(cache))
+
+    def set_preprocessor(self, preprocessor):
+        """
+        Sets the preprocessor, or the list of preprocessors, run on the
+        source of every template before Mako compiles it, like
+        haml.preprocessor to write all the templates in HAML. .haml files
+        are always converted.
+        """
+        if preprocessor is None:
+            preprocessor = []
+        elif callable(preprocessor):
+            preprocessor = [preprocessor]
+        self.preprocessors = list(preprocessor)
+        self._templates = None
+
+    def preprocessed_source(self, path):
+        """
+        Returns the Mako source that the template at path is compiled from,
+        after the HAML conversion and the other preprocessors. For
+        debugging, it does not need the template to compile.
+        """
+        for directory in self.templates.directories:
+            filename = os.path.join(directory, path)
+            if os.path.isfile(filename):
+                break
+        else:
+            raise IOError(errno.ENOENT, "no template %s" % path)
+        args = self.templates.template_args
+        with open(filename, "rb") as file_:
+            data = file_.read()
+        lexer = args["lexer_cls"](data, filename,
+            input_encoding=args["input_encoding"],
+            preprocessor=args["preprocessor"])
+        text = lexer.decode_raw_stream(data, True, lexer.encoding,
+            filename)[1]
+        for preprocessor in lexer.preprocessor:
+            text = preprocessor(text)
+        return text
+
+    def _lister(self):
+        key = (self.folder, tuple(self.file_exclusion), self.cache_dir,
+            tuple(self.directory_exclusion))
+        if getattr(self, "_tree_lister", None) is None or \
+                self._tree_lister[0] != key:
+            self._tree_lister = (key, TreeLister(self.folder,
+                self.file_exclusion, self._cache_path("listing.json"),
+                self.directory_exclusion))
+        return self._tree_lister[1]
+
+    def set_template_cache_size(self, size):
+        """
+        Sets the number of compiled templates kept in memory.
+        """
+        self.template_cache_size = size
+        self._templates = None
+
+    def _cache_path(self, *parts):
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            return None
+        if callable(cache_dir):
+            cache_dir = cache_dir(self.folder)
+        return os.path.join(self.folder, cache_dir, *parts)
+
+    def _template_module_path(self, filename, uri):
+        """
+        Returns the file where the compiled module of a template is stored.
+        It is named after a hash of the template source and of everything
+        else its code depends on, so it can be shared by every process
+        working on the site and is never used for another version of the
+        template.
+        """
+        cache = self._cache_path("templates")
+        if cache is None or not _writable_dir(cache):
+            # compiled in memory
+            return None
+        args = self.templates.template_args
+        sha = hashlib.sha1()
+        for part in [mako.__version__, uri, filename,
+                os.path.splitext(filename)[1], args["input_encoding"]] + \
+                list(args["imports"]) + \
+                [_callable_name(p) for p in args["preprocessor"]]:
+            sha.update(part.encode("utf-8") + b"\0")
+        with open(filename, "rb") as file_:
+            sha.update(file_.read())
+        return os.path.join(cache, sha.hexdigest() + ".py")
+
+    def compile_templates(self):
+        """
+        Compiles the templates of the pages to generate and every file in the
+        templates folder, so that their modules are in the cache directory
+        for the next processes. Returns the list of paths that failed to
+        compile.
+        """
+        paths = set()
+        for l in self.file_listers:
+            paths.update(p for p in l()
+                if p.split(".")[-1] in self.template_exts)
+        template_dir = os.path.join(self.folder, "templates")
+        for dirpath, dirnames, filenames in os.walk(template_dir):
+            for f in filenames:
+                if f.split(".")[-1] in self.template_exts:
+                    paths.add(os.path.relpath(os.path.join(dirpath, f),
+                        self.folder))
+        failed = []
+        for path in sorted(paths):
+            try:
+                self.templates.get_template(path)
+            except Exception:
+                _logger.error("failed to compile %s\n%s"
+                    % (path, traceback.format_exc()))
+                failed.append(path)
+        _logger.info("compiled %d templates" % (len(paths) - len(failed)))
+        return failed
+
     def set_production(self, val=False):
         if val not in (True, False):
             raise ArgumentError('Value must be True or False')
         self.production = val
-        self.manager = self._setup_manager()
+        self._manager = None
+
+    def _render_context_key(self):
+        mtime = None
+        if self.config_file:
+            try:
+                mtime = os.stat(self.config_file).st_mtime
+            except OSError:
+                pass
+        return (self.folder, self.config_file, mtime, id(self.manager),
+            self.manager.builds)
+
+    def render_context(self):
+        """
+        Returns the config dict and the asset urls given to the templates.
+        They are only computed again when the config file is modified or
+        the assets are built.
+        """
+        key = self._render_context_key()
+        if self._render_context is None or self._render_context[0] != key:
+            self.render_context_computations += 1
+            self._render_context = (key,
+                config_to_dict(self.folder, self.config_file),
+                self.manager.asset_urls())
+        return self._render_context[1:]
 
     def _setup_manager(self):
+        from assetmanager import AssetManager
         assets_config_path = os.path.relpath('assets.yml', self.folder)
         return AssetManager(assets_config_path,
-            production=self.production)
+            production=self.production, workers=self.asset_jobs,
+            cache_size=self.asset_cache_size)
+
+    def cached_renderer(self, cache):
+        """
+        Returns a file renderer that keeps the templates rendered for GET
+        requests in cache, a ResponseCache, and answers them with a strong
+        ETag so that clients can get 304 Not Modified responses.
+        """
+        def file_renderer(path, postprocessor=None):
+            if flask.request.method != 'GET' or \
+                    path.split(".")[-1] not in self.template_exts or \
+                    not self.templates.has_template(path):
+                return self.file_renderer(path, postprocessor)
+            context_key = self._render_context_key()
+            cached = cache.get(path, context_key)
+            if cached is None:
+                body = self.file_renderer(path, postprocessor)
+                if not isinstance(body, bytes):
+                    if not hasattr(body, "encode"):
+                        return body
+                    # what Flask would do with the text
+                    body = body.encode("utf-8")
+                files = template_dependencies(self.templates, path)
+                if files is None:
+                    etag = hashlib.sha1(body).hexdigest()
+                else:
+                    files = [_uncounted_template(self.templates,
+                        path).filename] + \
+                        sorted(files)
+                    etag = cache.put(path, context_key, files, body)
+                status = "MISS"
+            else:
+                body, etag = cached
+                status = "HIT"
+            response = flask.make_response(body)
+            response.set_etag(etag)
+            response.headers["X-PyGreen-Cache"] = status
+            return response.make_conditional(flask.request)
+        return file_renderer
+
+    def _serve_renderer(self):
+        if self.response_cache is None:
+            return self.file_renderer
+        return self.cached_renderer(self.response_cache)
+
+    def wsgi_app(self):
+        """
+        Returns the Flask app serving the site, a WSGI application without
+        debugger or reloader.
+        """
+        app = create_app(root_path=self.folder, config_file=self.config_file)
+        configure_views(app, self._serve_renderer(),
+            static_sender=self.send_static)
+        return app
 
     def run(self, host='0.0.0.0', port=8080, reload_assets=True):
         """
         Launch a development web server.
         """
-        app = create_app(root_path=self.folder, config_file=self.config_file)
-        configure_views(app, self.file_renderer)
+        app = self.wsgi_app()
         if reload_assets:
             app.before_first_request(self.manager.build_environment)
         app.run(host=host, port=port, debug=True,
             extra_files=self.manager.files_to_watch())
 
     def run_livereload(self):
-        app = create_app(root_path=self.folder, config_file=self.config_file)
-        configure_views(app, self.file_renderer)
+        from livereload import Server
+        from livereload.handlers import LiveReloadHandler
+        from tornado.ioloop import IOLoop
+        from assetmanager import BundleRebuilder
+        app = self.wsgi_app()
         server = Server(app)
+
+        def schedule(seconds, func):
+            # the watcher runs in the loop serving the pages
+            IOLoop.instance().add_timeout(time.time() + seconds, func)
+
+        def reload_pages(names):
+            # the pages were reloaded when the change was seen, before the
+            # bundles were built
+            message = {"command": "reload", "path": "*", "liveCSS": True}
+            for waiter in list(LiveReloadHandler.waiters):
+                try:
+                    waiter.write_message(message)
+                except Exception:
+                    LiveReloadHandler.waiters.discard(waiter)
+
+        # only the bundles using the changed files are built, and templates
+        # just need the page to be reloaded
+        rebuild = BundleRebuilder(self.manager, schedule=schedule,
+            built=reload_pages)
         for glob_pattern in self.manager.globs_to_watch():
-            server.watch('assets/%s' % glob_pattern,
-                self.manager.build_environment)
-        server.watch('templates/*', self.manager.build_environment)
-        server.watch('templates/**/*', self.manager.build_environment)
+            server.watch('assets/%s' % glob_pattern, rebuild)
+        server.watch('templates/*')
+        server.watch('templates/**/*')
         server.serve(host="0.0.0.0")
 
+    def _prepare_workers(self):
+        """
+        Builds the assets and compiles the templates, so that the workers
+        forked afterwards share them. Returns the app they serve.
+        """
+        self.manager.build_environment()
+        failed = self.compile_templates()
+        if failed:
+            _logger.warning("%d template(s) failed to compile" % len(failed))
+        return self.wsgi_app()
+
+    def run_workers(self, host='0.0.0.0', port=8080, workers=None):
+        """
+        Launch a production web server: workers processes, one per CPU by
+        default, accept the connections of a socket they share, without
+        debugger or reloader. The assets are built and the templates
+        compiled before the workers are forked.
+        On SIGHUP, the assets, templates and config are loaded again and new
+        workers replace the current ones, which finish their request first.
+        SIGTERM and SIGINT stop the server the same way.
+        """
+        workers = workers or multiprocessing.cpu_count()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        # every worker is woken up by a new connection, only one accepts it
+        sock.setblocking(0)
+        signals = []
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: signals.append(signum))
+        # every signal, and the SIGCHLD of an exiting worker, writes a byte
+        # into the pipe, so that the master cannot miss one arriving just
+        # before it waits
+        wakeup, wakeup_write = os.pipe()
+        for fd in (wakeup, wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        app = self._prepare_workers()
+        generation = 0
+        children = {}
+        stopping = False
+        _logger.info("serving on %s:%d with %d workers" % (host, port, workers))
+        while True:
+            for _ in range(workers - sum(1 for g in children.values()
+                    if g == generation)):
+                if not stopping:
+                    children[_fork_worker(sock, app, signals)] = generation
+            if not children:
+                break
+            while signals:
+                signum = signals.pop(0)
+                if signum == signal.SIGHUP and not stopping:
+                    _logger.info("reloading")
+                    generation += 1
+                    old = list(children)
+                    self._templates = None
+                    self._manager = None
+                    if self.response_cache is not None:
+                        self.response_cache = \
+                            ResponseCache(self.response_cache.max_size)
+                    app = self._prepare_workers()
+                    for _ in range(workers):
+                        children[_fork_worker(sock, app, signals)] = generation
+                    _signal_all(old, signal.SIGTERM)
+                elif signum != signal.SIGHUP and not stopping:
+                    _logger.info("stopping")
+                    stopping = True
+                    _signal_all(children, signal.SIGTERM)
+            exited = _reap_children(children)
+            if not exited and not signals:
+                _wait_readable(wakeup)
+            for pid, status in exited:
+                if children.pop(pid, None) == generation and not stopping:
+                    _logger.warning("worker %d exited with status %d" %
+                        (pid, status))
+                    # do not fork workers failing at startup in a tight loop
+                    time.sleep(1)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(wakeup)
+        os.close(wakeup_write)
+        sock.close()
+
+    def send_static(self, path):
+        """
+        Sends the static file at path, relative to the folder. The versioned
+        outputs of the asset bundles are sent as immutable.
+        """
+        full = os.path.join(self.folder, path)
+        if not os.path.isfile(full):
+            flask.abort(404)
+        return send_static(path, immutable=os.path.abspath(full) in
+            self.manager.versioned_outputs())
+
     def get(self, path):
         """
         Get the content of a file, indentified by its path relative to the folder configured
@@ -231,10 +2109,24 @@ class PyGreen(object):
         """
         app = create_app(root_path=self.folder, config_file=self.config_file)
         configure_views(app, self.file_renderer,
-            postprocessor=change_href_to_html)
+            postprocessor=self.postprocessor)
         data = app.test_client().get("/%s" % path).data
         return data
 
+    def renderer(self, postprocessor=None):
+        """
+        Returns a function that takes a path and gives the same content as get,
+        but builds the Flask app only once. Use it when rendering many files.
+        postprocessor defaults to self.postprocessor.
+        """
+        app = create_app(root_path=self.folder, config_file=self.config_file)
+        if postprocessor is None:
+            postprocessor = self.postprocessor
+        def render(path):
+            return render_response(app, self.file_renderer, path,
+                postprocessor)
+        return render
+
     # Support templates directory (vice root directory only) and
     # .haml or .mako suffix (vice .html) for static generation.
     def _process_path(self, input_path):
@@ -245,27 +2137,209 @@ class PyGreen(object):
             p = p.with_suffix('.html')
         return str(p)
 
-    def gen_static(self, output_folder, overwrite):
+    def _dependencies(self, path):
+        """
+        Returns whether path is rendered as a template, and the paths of the
+        other files its output depends on (None if they are not known).
+        """
+        for route in self.data_routes:
+            if route.has_page(path):
+                # every page depends on the whole dataset
+                return True, route.dependencies()
+        if path.split(".")[-1] in self.template_exts and \
+                self.templates.has_template(path):
+            filenames = template_dependencies(self.templates, path)
+            if filenames is None:
+                return True, None
+            return True, sorted(os.path.relpath(f, self.folder)
+                for f in filenames)
+        return False, []
+
+    def _context_digest(self):
+        """
+        Digest of what every template render depends on besides the
+        templates: the config file and the asset urls.
+        """
+        sha = hashlib.sha1()
+        if self.config_file and os.path.exists(self.config_file):
+            sha.update(file_digest(self.config_file).encode("ascii"))
+        urls = json.dumps(self.manager.asset_urls(), sort_keys=True)
+        sha.update(urls.encode("utf-8"))
+        return sha.hexdigest()
+
+    def _gen_file(self, render, output_folder, path, dependencies=False,
+            profiler=None, sync=False):
+        """
+        Renders path and writes it into output_folder. With sync, the file is
+        written atomically, and only if its content changed. Returns whether
+        the file was written and, if dependencies is True, the result of
+        _dependencies for the path. The steps are timed by profiler, a
+        GenProfiler, if given.
+        """
+        if profiler is not None:
+            with profiler.file(path, self.templates):
+                return self._gen_file_steps(render, output_folder, path,
+                    dependencies, profiler.phase, sync)
+        return self._gen_file_steps(render, output_folder, path,
+            dependencies, _no_phase, sync)
+
+    def _gen_file_steps(self, render, output_folder, path, dependencies,
+            phase, sync):
+        with phase("render"):
+            content = render(path)
+        with phase("write"):
+            loc = os.path.join(output_folder, self._process_path(path))
+            d = os.path.dirname(loc)
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # another worker may have created it in the meantime
+                    if not os.path.isdir(d):
+                        raise
+            if sync:
+                written = write_if_changed(loc, content)
+            else:
+                with open(loc, "wb") as file_:
+                    file_.write(content)
+                written = True
+        if dependencies:
+            return written, self._dependencies(path)
+        return written, None
+
+    def gen_static(self, output_folder, overwrite=False, jobs=1,
+            incremental=False, compress=None, profiler=None, sync=False,
+            shard=None):
         """
         Generates a complete static version of the web site and stores it in
-        output_folder.
+        output_folder. With jobs > 1 the files are rendered and written by a
+        pool of processes, and a GenerationError listing every failed file
+        is raised at the end if some of them could not be generated.
+
+        With incremental, a BuildManifest kept for output_folder is used to
+        only generate the files whose source, templates, config file or
+        asset urls changed since the last incremental generation.
+
+        With sync, output_folder is updated in place: files are only written
+        when their content changed, atomically, and the files that are not
+        generated anymore are deleted. Hidden files are left alone.
+
+        compress can be a Precompressor, run on every generated file.
+        profiler can be a GenProfiler, recording where the time goes.
+
+        shard can be (index, count), to only generate the files whose output
+        path falls into one of count shards, see shard_of. The output
+        folders of the shards are combined by merge_shards. When the shards
+        write into the same folder, sync only deletes the files of the
+        shard that no shard generates.
+
+        Returns the numbers of files written, unchanged and deleted.
         """
+        if overwrite and sync:
+            raise ValueError("overwrite and sync cannot be used together")
+        phase = profiler.phase if profiler is not None else _no_phase
+
         # remove existing output_folder + contents
         if overwrite and os.path.exists(output_folder):
             shutil.rmtree(output_folder)
 
-        files = []
-        for l in self.file_listers:
-            files += l()
-        for f in files:
+        with phase("list"):
+            files = []
+            for l in self.file_listers:
+                files += l()
+            # what every shard generates
+            all_outputs = [self._process_path(f) for f in files]
+            if shard is not None:
+                index, count = shard
+                files = [f for f in files
+                    if shard_of(self._process_path(f), count) == index]
+            outputs = [self._process_path(f) for f in files]
+
+        manifest = None
+        if incremental:
+            with phase("manifest"):
+                manifest = BuildManifest(self.folder, output_folder)
+                context = self._context_digest()
+                manifest.retain(outputs)
+                stale = [f for f in files if not manifest.is_fresh(
+                    self._process_path(f), f, context)]
+            _logger.info("%d of %d files are up to date"
+                % (len(files) - len(stale), len(files)))
+            files = stale
+
+        counts = {"written": 0, "unchanged": len(outputs) - len(files),
+            "deleted": 0}
+
+        def done(f, written, dependencies):
             _logger.info("generating %s" % f)
-            content = self.get(f)
-            loc = os.path.join(output_folder, self._process_path(f))
-            d = os.path.dirname(loc)
-            if not os.path.exists(d):
-                os.makedirs(d)
-            with open(loc, "wb") as file_:
-                file_.write(content)
+            counts["written" if written else "unchanged"] += 1
+            if manifest is not None:
+                template, paths = dependencies
+                manifest.record(self._process_path(f), f, paths,
+                    context if template else None)
+
+        try:
+            with phase("generate"):
+                if jobs > 1:
+                    self._gen_parallel(output_folder, files, jobs, done,
+                        manifest is not None, profiler, sync)
+                else:
+                    render = self.renderer() if profiler is None else \
+                        self.renderer(profiler.timed("postprocess",
+                            self.postprocessor))
+                    for f in files:
+                        done(f, *self._gen_file(render, output_folder, f,
+                            dependencies=manifest is not None,
+                            profiler=profiler, sync=sync))
+        finally:
+            if manifest is not None:
+                with phase("manifest"):
+                    manifest.save()
+        if sync:
+            with phase("delete"):
+                keep = set(all_outputs)
+                if compress is not None:
+                    keep.update(output + ext for output in all_outputs
+                        for encoding, ext in PRECOMPRESSED_ENCODINGS)
+                owned = None
+                if shard is not None:
+                    # the other shards may write into the same folder
+                    owned = lambda relpath: shard_of(relpath, count) == index
+                counts["deleted"] = delete_orphans(output_folder, keep,
+                    owned)
+        if compress is not None:
+            with phase("compress"):
+                compress.run(outputs)
+        _logger.info("%(written)d written, %(unchanged)d unchanged, "
+            "%(deleted)d deleted" % counts)
+        return counts
+
+    def _gen_parallel(self, output_folder, files, jobs, done, dependencies,
+            profiler=None, sync=False):
+        # the workers are forked, so they inherit this instance with its
+        # listers, renderer and settings
+        pool = multiprocessing.Pool(jobs, _init_gen_worker,
+            (self, output_folder, dependencies, profiler, sync))
+        errors = {}
+        try:
+            chunksize = max(1, len(files) // (jobs * 4))
+            for f, error, written, dependencies, timings in pool.imap(
+                    _gen_worker_file, files, chunksize):
+                if error is None:
+                    done(f, written, dependencies)
+                    if profiler is not None:
+                        profiler.files[f] = timings
+                else:
+                    _logger.error("failed to generate %s\n%s" % (f, error))
+                    errors[f] = error
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if errors:
+            raise GenerationError(errors)
 
     def cli(self, cmd_args=None):
         """
@@ -296,14 +2370,34 @@ class PyGreen(object):
             help='use production filters')
         parser_serve.add_argument('-c', '--config-file',
             default="default.cfg", help='config file')
+        parser_serve.add_argument('--template-cache-size', type=int,
+            default=100, help='number of compiled templates kept in memory')
+        parser_serve.add_argument('-w', '--workers', type=int, default=None,
+            help='serve with this many worker processes, without debugger '
+            'or reloader, 0 for one per CPU')
+        parser_serve.add_argument('--asset-cache-size', type=int,
+            default=64, help='megabytes of built assets kept across runs, '
+            '0 to disable')
+        parser_serve.add_argument('--response-cache-size', type=int,
+            default=32, help='megabytes of rendered pages kept in memory, '
+            '0 to disable')
 
         def serve():
+            self.set_template_cache_size(args.template_cache_size)
+            if args.response_cache_size > 0:
+                self.response_cache = \
+                    ResponseCache(args.response_cache_size * 1024 * 1024)
+            else:
+                self.response_cache = None
+            self.asset_cache_size = args.asset_cache_size * 1024 * 1024
             if args.disable_templates:
                 self.template_exts = set([])
             config_rel_path = os.path.relpath(args.config_file, self.folder)
             self.config_file = os.path.abspath(config_rel_path)
             self.set_production(args.production)
-            if args.livereload:
+            if args.workers is not None:
+                self.run_workers(port=args.port, workers=args.workers)
+            elif args.livereload:
                 self.run_livereload()
             else:
                 self.run(port=args.port, reload_assets=args.reload)
@@ -316,25 +2410,153 @@ class PyGreen(object):
             help='folder to store the files')
         parser_gen.add_argument('-f', '--folder', default=".",
             help='folder containing files to serve')
-        parser_gen.add_argument('-o', '--overwrite',
+        write_mode = parser_gen.add_mutually_exclusive_group()
+        write_mode.add_argument('-o', '--overwrite',
             action="store_true", default=False,
             help='overwrite existing output folder')
+        write_mode.add_argument('-s', '--sync',
+            action="store_true", default=False,
+            help='update the output folder in place: only write the files '
+            'that changed and delete the ones not generated anymore')
         parser_gen.add_argument('-z', '--production',
             action="store_true", default=False,
             help='use production filters')
         parser_gen.add_argument('-c', '--config-file',
             default="default.cfg", help='config file')
+        parser_gen.add_argument('--template-cache-size', type=int,
+            default=100, help='number of compiled templates kept in memory')
+        parser_gen.add_argument('--asset-jobs', type=int, default=None,
+            help='number of asset bundles built at the same time')
+        parser_gen.add_argument('--asset-cache-size', type=int,
+            default=64, help='megabytes of built assets kept across runs, '
+            '0 to disable')
+        parser_gen.add_argument('--compress', default=None,
+            help='comma separated encodings (gzip, br) of the compressed '
+            'files to write next to the generated ones')
+        parser_gen.add_argument('--compress-min-size', type=int,
+            default=1024, help='size in bytes under which files are not '
+            'compressed')
+        parser_gen.add_argument('-i', '--incremental',
+            action="store_true", default=False,
+            help='only generate the files whose sources changed')
+        parser_gen.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of processes rendering files, 0 for one per CPU')
+        parser_gen.add_argument('--shard', type=_shard_argument, default=None,
+            metavar='I/N', help='only generate the I-th of N shards of the '
+            'site, and use the asset bundles already built; combine the '
+            'shards with merge')
+        parser_gen.add_argument('--watch', action="store_true", default=False,
+            help='keep running, and generate again incrementally the files '
+            'affected by each change')
+        parser_gen.add_argument('--watch-interval', type=float, default=1.0,
+            help='seconds between two checks for changes when watchdog is '
+            'not installed')
+        parser_gen.add_argument('--profile', default=None, metavar='REPORT',
+            help='write a JSON report of the time spent in each phase and '
+            'on each file into REPORT, and log the slowest ones')
+        parser_gen.add_argument('--profile-top', type=int, default=10,
+            help='number of slowest files and templates to log')
+        parser_gen.add_argument('--profile-path', default=None,
+            help='run the generation of this file under cProfile')
+        parser_gen.add_argument('--profile-output', default='pygreen.prof',
+            help='file to dump the cProfile stats of --profile-path into')
 
         def gen():
             assets_config_path = os.path.relpath('assets.yml', self.folder)
             config_rel_path = os.path.relpath(args.config_file, self.folder)
             self.config_file = os.path.abspath(config_rel_path)
+            self.asset_jobs = args.asset_jobs
+            self.asset_cache_size = args.asset_cache_size * 1024 * 1024
+            profiler = None
+            if args.profile or args.profile_path:
+                profiler = GenProfiler(args.profile_path, args.profile_output)
+            phase = profiler.phase if profiler is not None else _no_phase
             self.set_production(args.production)
-            self.manager.build_environment(force=True)
-            self.gen_static(args.output, overwrite=args.overwrite)
+            self.set_template_cache_size(args.template_cache_size)
+            with phase("assets"):
+                # the shards share the bundles of the assets command
+                self.manager.build_environment(force=args.shard is None)
+            jobs = args.jobs or multiprocessing.cpu_count()
+            compress = None
+            if args.compress:
+                compress = Precompressor(args.output,
+                    [e.strip() for e in args.compress.split(",")],
+                    min_size=args.compress_min_size, jobs=jobs)
+            # watching needs the manifest of an incremental generation
+            self.gen_static(args.output, overwrite=args.overwrite, jobs=jobs,
+                incremental=args.incremental or args.watch,
+                compress=compress, profiler=profiler, sync=args.sync,
+                shard=args.shard)
+            if profiler is None:
+                _logger.info("templates: %d hits, %d misses"
+                    % (self.templates.hits, self.templates.misses))
+            else:
+                profiler.log_summary(args.profile_top)
+                if args.profile:
+                    profiler.save(args.profile,
+                        {"assets": self.manager.last_build_report})
+            if args.watch:
+                GenWatcher(self, args.output, interval=args.watch_interval,
+                    jobs=jobs, compress=compress, sync=args.sync).run()
 
         parser_gen.set_defaults(func=gen)
 
+        parser_assets = subparsers.add_parser('assets',
+            help='build the asset bundles, before running gen --shard')
+        parser_assets.add_argument('-f', '--folder', default=".",
+            help='folder containing files to serve')
+        parser_assets.add_argument('-z', '--production',
+            action="store_true", default=False,
+            help='use production filters')
+        parser_assets.add_argument('--asset-jobs', type=int, default=None,
+            help='number of asset bundles built at the same time')
+
+        def build_assets():
+            self.asset_jobs = args.asset_jobs
+            self.set_production(args.production)
+            self.manager.build_environment(force=True)
+
+        parser_assets.set_defaults(func=build_assets)
+
+        parser_merge = subparsers.add_parser('merge',
+            help='combine the output folders of gen --shard')
+        parser_merge.add_argument('output',
+            help='folder to store the files')
+        parser_merge.add_argument('shards', nargs='+',
+            help='output folders of the shards')
+        parser_merge.add_argument('-s', '--sync',
+            action="store_true", default=False,
+            help='delete the files of the output folder that are in none '
+            'of the shards')
+
+        def merge():
+            merge_shards(args.output, args.shards, sync=args.sync)
+
+        parser_merge.set_defaults(func=merge, folder=".")
+
+        parser_compile = subparsers.add_parser('compile',
+            help='compile the templates into the cache directory')
+        parser_compile.add_argument('-f', '--folder', default=".",
+            help='folder containing files to serve')
+
+        def compile_templates():
+            if self.compile_templates():
+                sys.exit(1)
+
+        parser_compile.set_defaults(func=compile_templates)
+
+        parser_preprocess = subparsers.add_parser('preprocess',
+            help='print the Mako source a template is compiled from')
+        parser_preprocess.add_argument('path',
+            help='path of the template, relative to the folder')
+        parser_preprocess.add_argument('-f', '--folder', default=".",
+            help='folder containing files to serve')
+
+        def preprocess():
+            sys.stdout.write(self.preprocessed_source(args.path).encode("utf-8"))
+
+        parser_preprocess.set_defaults(func=preprocess)
+
         args = parser.parse_args(cmd_args)
 
         self.set_folder(args.folder)
@@ -344,6 +2566,381 @@ class PyGreen(object):
 
         args.func()
 
+
+class GenWatcher(object):
+    """
+    Keeps a generated site up to date: watches the files a generation of a
+    PyGreen instance reads, see _watched, and after each burst of changes
+    rebuilds the bundles using the changed files and regenerates
+    incrementally the outputs depending on them. The templates,
+    the asset environment and the render context stay loaded between runs.
+    Changes wake the watcher up at once if watchdog is installed, otherwise
+    they are polled every interval seconds. Changes coming less than
+    debounce seconds apart are generated as one batch.
+    """
+
+    def __init__(self, green, output_folder, debounce=0.2, interval=1.0,
+            **options):
+        from assetmanager import BundleRebuilder
+        self.green = green
+        self.output_folder = output_folder
+        self.debounce = debounce
+        self.interval = interval
+        # passed to gen_static
+        self.options = options
+        self._wakeup = threading.Event()
+        # the paths of the watchdog events since the last check, None when
+        # polling
+        self._events = None
+        self._lock = threading.Lock()
+        self._rebuild = None
+        if green.manager.environment:
+            # the watcher debounces already
+            self._rebuild = BundleRebuilder(green.manager, debounce=0,
+                built=self._bundles_built)
+        self._sources = self._manifest_sources()
+        self._mtimes = self._stat(self._watched())
+
+    def _manifest_sources(self):
+        manifest = BuildManifest(self.green.folder, self.output_folder)
+        return set(os.path.join(self.green.folder, p)
+            for p in manifest.sources())
+
+    def _watched(self):
+        """
+        Returns the absolute paths of the files a generation reads: the
+        files to generate, the templates, the sources recorded in the
+        manifest, the config file and the files of the asset bundles.
+        The excluded directories are not searched.
+        """
+        folder = self.green.folder
+        paths = set(self._sources)
+        for lister in self.green.file_listers:
+            paths.update(os.path.join(folder, p) for p in lister())
+        # the layouts and includes are not listed
+        templates = os.path.join(folder, "templates")
+        excluded = set(self.green.directory_exclusion)
+        for dirpath, dirnames, filenames in os.walk(templates):
+            dirnames[:] = [d for d in dirnames
+                if not d.startswith(".") and d not in excluded]
+            paths.update(os.path.join(dirpath, f) for f in filenames
+                if not f.startswith("."))
+        if self.green.config_file:
+            paths.add(self.green.config_file)
+        paths.update(self.green.manager.bundle_files())
+        return set(os.path.abspath(p) for p in paths)
+
+    def _stat(self, paths):
+        """
+        Maps each of the paths that exist to its mtime and size.
+        """
+        mtimes = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            mtimes[path] = (st.st_mtime, st.st_size)
+        return mtimes
+
+    def _changes(self):
+        """
+        Returns the paths of the watched files created, modified or deleted
+        since the last call. With watchdog, only the paths of the events
+        are checked.
+        """
+        if self._events is None:
+            paths = self._watched() | set(self._mtimes)
+        else:
+            with self._lock:
+                events, self._events = self._events, set()
+            paths = set(p for p in events if p in self._mtimes)
+            if len(paths) < len(events):
+                # maybe new files
+                paths |= events & self._watched()
+        mtimes = self._stat(paths)
+        changed = set(path for path in paths
+            if mtimes.get(path) != self._mtimes.get(path))
+        for path in paths:
+            if path in mtimes:
+                self._mtimes[path] = mtimes[path]
+            else:
+                self._mtimes.pop(path, None)
+        return changed
+
+    def _bundles_built(self, names):
+        # the outputs of the bundles are not changes to generate again,
+        # the run following the build takes them
+        self._mtimes.update(self._stat(
+            self.green.manager.bundle_outputs(names)))
+
+    def check(self):
+        """
+        Regenerates the site if files changed since the last call, once they
+        stopped changing. Returns the result of gen_static, or None if
+        nothing changed.
+        """
+        changed = self._changes()
+        if not changed:
+            return None
+        while True:
+            time.sleep(self.debounce)
+            more = self._changes()
+            if not more:
+                break
+            changed |= more
+        _logger.info("%d file(s) changed: %s" % (len(changed),
+            ", ".join(sorted(os.path.relpath(p) for p in changed)[:5])))
+        return self.generate()
+
+    def generate(self):
+        if self._rebuild is not None:
+            self._rebuild()
+        try:
+            return self.green.gen_static(self.output_folder,
+                incremental=True, **self.options)
+        finally:
+            self._sources = self._manifest_sources()
+
+    def _observe(self):
+        """
+        Starts a watchdog observer setting _wakeup on every file event, or
+        returns None if watchdog is not installed.
+        """
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return None
+        def on_any_event(event):
+            if not event.is_directory:
+                paths = [event.src_path, getattr(event, "dest_path", None)]
+                with self._lock:
+                    self._events.update(os.path.abspath(p)
+                        for p in paths if p)
+            self._wakeup.set()
+
+        handler = FileSystemEventHandler()
+        handler.on_any_event = on_any_event
+        folders = set([os.path.abspath(self.green.folder)])
+        if self.green.config_file:
+            folders.add(os.path.dirname(os.path.abspath(
+                self.green.config_file)))
+        folders.update(os.path.dirname(path)
+            for path in self.green.manager.bundle_files())
+        self._events = set()
+        observer = Observer()
+        for folder in sorted(folders):
+            if not any(folder.startswith(f + os.sep) for f in folders):
+                observer.schedule(handler, folder, recursive=True)
+        observer.start()
+        return observer
+
+    def run(self):
+        """
+        Watches until interrupted. Failed generations are logged, and
+        retried on the next change.
+        """
+        observer = self._observe()
+        _logger.info("watching %s for changes%s" % (self.green.folder,
+            "" if observer else ", polling every %ss" % self.interval))
+        try:
+            while True:
+                # a timeout keeps the loop interruptible
+                woken = self._wakeup.wait(self.interval)
+                if observer is not None and not woken:
+                    continue
+                self._wakeup.clear()
+                try:
+                    self.check()
+                except Exception:
+                    _logger.exception("failed to generate the site")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+
+def _shard_argument(value):
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, like 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("I must be from 1 to N")
+    return index - 1, count
+
+
+class _WorkerServer(WSGIServer):
+    """
+    WSGIServer accepting the connections of a socket shared with other
+    processes.
+    """
+
+    def __init__(self, sock, app):
+        WSGIServer.__init__(self, sock.getsockname(), _QuietRequestHandler,
+            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        # how often handle_request checks if the worker must stop
+        self.timeout = 1
+
+    def handle_request(self):
+        # the one of SocketServer takes the non-blocking socket for a
+        # timeout of 0, and would spin
+        try:
+            if not select.select([self], [], [], self.timeout)[0]:
+                return
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        self._handle_request_noblock()
+
+    def get_request(self):
+        conn, address = self.socket.accept()
+        conn.setblocking(1)
+        return conn, address
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        _logger.info("%s - %s" % (self.client_address[0], format % args))
+
+
+def _fork_worker(sock, app, signals=()):
+    """
+    Forks a worker serving app on sock. signals is the list the handlers of
+    the master append to: until the worker installs its own, the signals
+    it receives land in its copy of it.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        stop = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(1))
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.append(1))
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if any(signum != signal.SIGHUP for signum in signals):
+            # the master is stopping, or was asked to
+            stop.append(1)
+        # the wakeup pipe and SIGCHLD handler are the master's
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        server = _WorkerServer(sock, app)
+        while not stop:
+            server.handle_request()
+    except Exception:
+        _logger.exception("worker %d failed" % os.getpid())
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def _reap_children(pids):
+    """
+    Returns the (pid, status) of the children in pids that exited, without
+    waiting. Other children, like the processes run by the asset filters,
+    are left to whoever started them.
+    """
+    exited = []
+    for pid in list(pids):
+        while True:
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # already reaped
+                done, status = pid, 0
+            break
+        if done:
+            exited.append((pid, status))
+    return exited
+
+
+def _wait_readable(fd):
+    """
+    Waits until fd, a non-blocking pipe, can be read, and empties it.
+    """
+    try:
+        select.select([fd], [], [])
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+def _signal_all(pids, signum):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+
+def make_wsgi_app(folder=".", config_file="default.cfg", production=False):
+    """
+    Returns a WSGI application serving the site in folder, for WSGI servers
+    like gunicorn or mod_wsgi. config_file is relative to folder. The assets
+    are built and the templates compiled first.
+    """
+    green = PyGreen()
+    green.set_folder(folder)
+    if config_file:
+        green.config_file = os.path.abspath(os.path.join(folder, config_file))
+    green.set_production(production)
+    return green._prepare_workers()
+
+
+# state of a gen_static worker process, set by _init_gen_worker
+_gen_worker = None
+
+def _init_gen_worker(green, output_folder, dependencies, profiler, sync):
+    global _gen_worker
+    try:
+        # each worker compiles its own templates and has its own asset
+        # manager, the bundles were already built by the parent process
+        green.templates = green._get_templates()
+        green.manager = green._setup_manager()
+        render = green.renderer() if profiler is None else \
+            green.renderer(profiler.timed("postprocess", green.postprocessor))
+        _gen_worker = (green, render, output_folder, dependencies, profiler,
+            sync)
+    except Exception:
+        # a failing initializer makes the pool start new workers forever,
+        # the error is reported for each file instead
+        _gen_worker = traceback.format_exc()
+
+def _gen_worker_file(path):
+    if not isinstance(_gen_worker, tuple):
+        return path, _gen_worker, None, None, None
+    green, render, output_folder, dependencies, profiler, sync = _gen_worker
+    try:
+        written, dependencies = green._gen_file(render, output_folder, path,
+            dependencies=dependencies, profiler=profiler, sync=sync)
+    except Exception:
+        return path, traceback.format_exc(), None, None, None
+    timings = profiler.files.pop(path) if profiler is not None else None
+    return path, None, written, dependencies, timings
+
 pygreen = PyGreen()
 
 if __name__ == "__main__":
@@ -3,10 +3,19 @@ from __future__ import unicode_literals, print_function
 
 import unittest
 import pygreen
+import filters
+import assetmanager
 import shutil
 import os
 import os.path
 import haml
+import time
+import gzip
+import io
+import json
+import signal
+import socket
+import urllib2
 
 _folder = os.path.join(os.path.dirname(__file__), "tests")
 _output = os.path.join(_folder, "output")
@@ -15,10 +24,19 @@ class TestSequenceFunctions(unittest.TestCase):
 
     def setUp(self):
         os.makedirs(_output)
+        # the default cache directory, used by make_wsgi_app
+        self.xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.abspath(
+            os.path.join(_output, "xdg"))
         self.pygreen = pygreen.PyGreen()
+        self.pygreen.cache_dir = os.path.abspath(os.path.join(_output, "cache"))
 
     def tearDown(self):
         self.pygreen = None
+        if self.xdg_cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.xdg_cache_home
         shutil.rmtree(_output)
 
     def test_static_get(self):
@@ -41,6 +59,694 @@ class TestSequenceFunctions(unittest.TestCase):
             value = _file.read()
         self.assertEqual(value.strip(), b"3+2=5")
 
+    def test_gen_jobs(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        serial, parallel = [os.path.join(_output, d) for d in ("j1", "j2")]
+        self.pygreen.gen_static(serial)
+        self.pygreen.gen_static(parallel, jobs=2)
+        for name in ("static/test.txt", "test.html"):
+            with open(os.path.join(serial, name), "rb") as _file:
+                expected = _file.read()
+            with open(os.path.join(parallel, name), "rb") as _file:
+                self.assertEqual(_file.read(), expected)
+        self.assertEqual(os.listdir(os.path.join(serial, "static")), ["test.txt"])
+
+    def test_gen_incremental(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_gen_static"), site)
+        self.pygreen.set_folder(site)
+        out = os.path.join(_output, "out")
+        generated = []
+        render = self.pygreen.renderer
+        def renderer():
+            r = render()
+            def record(path):
+                generated.append(path)
+                return r(path)
+            return record
+        self.pygreen.renderer = renderer
+
+        self.pygreen.gen_static(out, incremental=True)
+        self.assertEqual(sorted(generated),
+            ["static/test.txt", "templates/test.mako"])
+        # the manifest is not deployed with the site
+        self.assertEqual(sorted(os.listdir(out)), ["static", "test.html"])
+        self.assertTrue(os.path.exists(os.path.join(
+            pygreen.output_state_dir(out), pygreen.BuildManifest.name)))
+        del generated[:]
+        self.pygreen.gen_static(out, incremental=True)
+        self.assertEqual(generated, [])
+
+        with open(os.path.join(site, "templates/layouts/base.mako"), "w") as _file:
+            _file.write("<p>${self.body()}</p>\n")
+        self.pygreen.templates = self.pygreen._get_templates()
+        self.pygreen.gen_static(out, incremental=True)
+        self.assertEqual(generated, ["templates/test.mako"])
+        with open(os.path.join(out, "test.html"), "rb") as _file:
+            self.assertTrue(_file.read().startswith(b"<p>\n3+2=5"))
+
+    def test_compile_templates(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        self.assertEqual(self.pygreen.compile_templates(), [])
+        modules = os.listdir(os.path.join(_output, "cache", "templates"))
+        self.assertEqual(len([m for m in modules if m.endswith(".py")]), 2)
+
+        other = pygreen.PyGreen()
+        other.cache_dir = self.pygreen.cache_dir
+        other.set_folder(self.pygreen.folder)
+        value = other.get("templates/test.mako")
+        self.assertTrue(value.startswith(b'<div class="output">\n3+2=5'))
+        self.assertEqual(os.listdir(os.path.join(_output, "cache", "templates")),
+            modules)
+        self.assertEqual(other.templates.misses, 2)
+
+    def test_cache_dir(self):
+        site = os.path.join(_folder, "input_gen_static")
+        cache = pygreen.PyGreen()._cache_path()
+        self.assertFalse(os.path.abspath(cache).startswith(
+            os.path.abspath(site) + os.sep))
+        self.assertEqual(cache, pygreen.site_cache_dir("."))
+        self.assertTrue(cache.startswith(os.environ["XDG_CACHE_HOME"]))
+
+        # a cache that cannot be written to is not used
+        blocker = os.path.abspath(os.path.join(_output, "file"))
+        with open(blocker, "wb"):
+            pass
+        self.pygreen.cache_dir = os.path.join(blocker, "cache")
+        self.pygreen.set_folder(site)
+        value = self.pygreen.get("templates/test.mako")
+        self.assertTrue(value.startswith(b'<div class="output">\n3+2=5'))
+        self.assertIn(os.path.join("templates", "test.mako"),
+            self.pygreen.file_listers[0]())
+
+    def test_template_counts(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        render = self.pygreen.renderer()
+        for _ in range(3):
+            render("templates/test.mako")
+        # the page is looked up once per render, its layout once per render
+        # through the inheritance
+        self.assertEqual((self.pygreen.templates.hits,
+            self.pygreen.templates.misses), (4, 2))
+        # walking the dependencies of the page is not counted
+        self.assertEqual(self.pygreen._dependencies("templates/test.mako"),
+            (True, [os.path.join("templates", "layouts", "base.mako")]))
+        self.assertEqual((self.pygreen.templates.hits,
+            self.pygreen.templates.misses), (4, 2))
+        self.assertFalse(self.pygreen.templates.has_template("missing.mako"))
+
+    def test_render_context(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_mako"))
+        config = os.path.abspath(os.path.join(_output, "test.cfg"))
+        with open(config, "w") as _file:
+            _file.write("TITLE = 'test'\n")
+        self.pygreen.config_file = config
+        render = self.pygreen.renderer()
+        render("test.html")
+        render("test.html")
+        self.assertEqual(self.pygreen.render_context_computations, 1)
+        self.assertEqual(self.pygreen.render_context()[0]["TITLE"], "test")
+        os.utime(config, (0, 0))
+        render("test.html")
+        self.assertEqual(self.pygreen.render_context_computations, 2)
+        self.pygreen.manager.build_environment()
+        render("test.html")
+        self.assertEqual(self.pygreen.render_context_computations, 3)
+
+    def test_response_cache(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_gen_static"), site)
+        self.pygreen.set_folder(site)
+        cache = pygreen.ResponseCache()
+        app = pygreen.create_app(root_path=site)
+        pygreen.configure_views(app, self.pygreen.cached_renderer(cache))
+        client = app.test_client()
+
+        first = client.get("/templates/test.mako")
+        self.assertEqual(first.headers["X-PyGreen-Cache"], "MISS")
+        second = client.get("/templates/test.mako")
+        self.assertEqual(second.headers["X-PyGreen-Cache"], "HIT")
+        self.assertEqual(second.data, first.data)
+        etag = first.headers["ETag"]
+        self.assertEqual(second.headers["ETag"], etag)
+        not_modified = client.get("/templates/test.mako",
+            headers={"If-None-Match": etag})
+        self.assertEqual(not_modified.status_code, 304)
+
+        layout = os.path.join(site, "templates/layouts/base.mako")
+        with open(layout, "w") as _file:
+            _file.write("<p>${self.body()}</p>\n")
+        later = time.time() + 10
+        os.utime(layout, (later, later))
+        third = client.get("/templates/test.mako")
+        self.assertEqual(third.headers["X-PyGreen-Cache"], "MISS")
+        self.assertTrue(third.data.startswith(b"<p>"))
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_filters(self):
+        from markdown import markdown
+        from smartypants import smartypants
+        text = "Some *text* -- with \"quotes\"\n\n---\n\nand a footer"
+        size = filters.cache.size
+        filters.set_cache_size(10)
+        try:
+            expected = smartypants(markdown(text))
+            self.assertEqual(filters.smartydown(text), expected)
+            self.assertEqual(filters.smartydown(text), expected)
+            self.assertEqual((filters.cache.hits, filters.cache.misses),
+                (1, 1))
+            self.assertEqual(filters.smartydown_many([text, "# Title", text]),
+                [expected, smartypants(markdown("# Title")), expected])
+            section = filters.sectionize(text)
+            self.assertTrue(section.startswith('<section class="two-column">'))
+            self.assertEqual(filters.sectionize(text), section)
+        finally:
+            filters.set_cache_size(size)
+
+    def test_lister(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_gen_static"), site)
+        os.makedirs(os.path.join(site, "static", ".git"))
+        with open(os.path.join(site, "static", ".git", "HEAD"), "w") as _file:
+            _file.write("ref")
+        self.pygreen.set_folder(site)
+        lister = self.pygreen.file_listers[0]
+        self.assertEqual(lister(), ["static/test.txt", "templates/test.mako"])
+        os.makedirs(os.path.join(site, "static", "new"))
+        with open(os.path.join(site, "static", "new", "file.py"), "w") as _file:
+            _file.write("")
+        with open(os.path.join(site, "static", "new", "file.txt"), "w") as _file:
+            _file.write("")
+        self.assertEqual(lister(), ["static/new/file.txt", "static/test.txt",
+            "templates/test.mako"])
+
+    def _assets_site(self):
+        site = os.path.abspath(os.path.join(_output, "site"))
+        os.makedirs(os.path.join(site, "assets"))
+        for name in ("a", "b"):
+            with open(os.path.join(site, "assets", name + ".js"), "w") as _file:
+                _file.write("var %s;\n" % name)
+        with open(os.path.join(site, "assets.yml"), "w") as _file:
+            _file.write("b:\n  contents: [gen/a.js, b.js]\n  output: gen/b.js\n"
+                "a:\n  contents: a.js\n  output: gen/a.js\n")
+        return site
+
+    def test_build_bundles(self):
+        site = self._assets_site()
+        cwd = os.getcwd()
+        os.chdir(site)
+        try:
+            manager = assetmanager.AssetManager("assets.yml", workers=2)
+            manager.build_environment(force=True)
+        finally:
+            os.chdir(cwd)
+        with open(os.path.join(site, "assets", "gen", "b.js")) as _file:
+            self.assertEqual(_file.read().split(), ["var", "a;", "var", "b;"])
+        self.assertEqual(sorted(manager.last_build_report["bundles"]),
+            ["a", "b"])
+
+    def test_bundle_rebuilder(self):
+        site = self._assets_site()
+        cwd = os.getcwd()
+        os.chdir(site)
+        try:
+            manager = assetmanager.AssetManager("assets.yml")
+            manager.build_environment(force=True)
+            rebuild = assetmanager.BundleRebuilder(manager, debounce=0)
+            rebuild()
+            self.assertEqual(manager.builds, 1)
+            later = time.time() + 10
+            os.utime(os.path.join(site, "assets", "b.js"), (later, later))
+            rebuild()
+            self.assertEqual(list(manager.last_build_report["bundles"]), ["b"])
+            os.utime(os.path.join(site, "assets", "a.js"), (later, later))
+            rebuild()
+            self.assertEqual(sorted(manager.last_build_report["bundles"]),
+                ["a", "b"])
+            self.assertEqual(manager.builds, 3)
+
+            # a file saved during a build is built again
+            def save(names):
+                if manager.builds == 4:
+                    os.utime(os.path.join(site, "assets", "b.js"),
+                        (later, later + 2))
+            rebuild.built = save
+            os.utime(os.path.join(site, "assets", "b.js"), (later, later + 1))
+            rebuild()
+            self.assertEqual(manager.builds, 5)
+
+            # without blocking the caller
+            scheduled = []
+            rebuild = assetmanager.BundleRebuilder(manager, debounce=0.5,
+                schedule=lambda seconds, func: scheduled.append(func))
+            os.utime(os.path.join(site, "assets", "b.js"), (later, later))
+            rebuild()
+            rebuild()
+            self.assertEqual((manager.builds, len(scheduled)), (5, 1))
+            scheduled.pop()()
+            self.assertEqual((manager.builds, scheduled), (6, []))
+        finally:
+            os.chdir(cwd)
+
+    def test_bundle_cache(self):
+        site = self._assets_site()
+        cwd = os.getcwd()
+        os.chdir(site)
+        try:
+            assetmanager.AssetManager("assets.yml").build_environment(
+                force=True)
+            output = os.path.join(site, "assets", "gen", "b.js")
+            os.remove(output)
+            # a new process finds the bundles in the cache
+            manager = assetmanager.AssetManager("assets.yml")
+            manager.build_environment(force=True)
+            self.assertEqual(sorted(manager.last_build_report["cached"]),
+                ["a", "b"])
+            with open(output) as _file:
+                self.assertEqual(_file.read().split(),
+                    ["var", "a;", "var", "b;"])
+            with open(os.path.join(site, "assets", "b.js"), "a") as _file:
+                _file.write("var c;\n")
+            manager.build_environment(force=True)
+            self.assertEqual(manager.last_build_report["cached"], ["a"])
+            with open(output) as _file:
+                self.assertEqual(_file.read().split()[-1], "c;")
+        finally:
+            os.chdir(cwd)
+
+        cache = assetmanager.BoundedFilesystemCache(
+            os.path.join(_output, "cache"), 10000)
+        for i in range(4):
+            cache.set(("key", i), b"x" * 1000)
+            os.utime(cache._filename(("key", i)), (i, i))
+        cache.get(("key", 1))
+        cache.max_size = 2500
+        cache.set(("key", 4), b"x" * 1000)
+        self.assertEqual([i for i in range(5)
+            if cache.get(("key", i)) is not None], [1, 4])
+
+    def test_precompress(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        out = os.path.join(_output, "out")
+        compress = pygreen.Precompressor(out, ["gzip"], min_size=0)
+        self.pygreen.gen_static(out, compress=compress)
+        with open(os.path.join(out, "test.html"), "rb") as _file:
+            html = _file.read()
+        with gzip.open(os.path.join(out, "test.html.gz"), "rb") as _file:
+            self.assertEqual(_file.read(), html)
+        self.assertTrue(os.path.exists(os.path.join(out, "static/test.txt.gz")))
+        self.assertEqual(compress.run(["test.html", "static/test.txt"]), 0)
+
+        with open(os.path.join(out, "test.txt"), "wb") as _file:
+            _file.write(b"test\n")
+        self.assertEqual(compress.run(["test.txt"]), 1)
+        self.pygreen.set_folder(out)
+        app = pygreen.create_app(root_path=out)
+        pygreen.configure_views(app, self.pygreen.file_renderer)
+        response = app.test_client().get("/test.txt",
+            headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(response.mimetype, "text/plain")
+        response = app.test_client().get("/test.txt")
+        self.assertEqual(response.data, b"test\n")
+        # the generated pages are not rendered again as templates
+        response = app.test_client().get("/test.html",
+            headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        with open(os.path.join(out, "test.html.gz"), "rb") as _file:
+            self.assertEqual(response.data, _file.read())
+        # the index is not deployed with the site
+        self.assertEqual(sorted(os.listdir(out)), ["static", "test.html",
+            "test.html.gz", "test.txt", "test.txt.gz"])
+
+        # .gz files that Precompressor did not write for the current content
+        # are not sent in place of the file
+        with open(os.path.join(out, "test.txt"), "wb") as _file:
+            _file.write(b"changed\n")
+        with open(os.path.join(out, "data.json"), "wb") as _file:
+            _file.write(b"{}")
+        with gzip.open(os.path.join(out, "data.json.gz"), "wb") as _file:
+            _file.write(b"other")
+        for url, data in (("/test.txt", b"changed\n"), ("/data.json", b"{}")):
+            response = app.test_client().get(url,
+                headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(response.data, data)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertNotIn("Vary", response.headers)
+
+    def test_send_static(self):
+        folder = os.path.join(_folder, "input_gen_static")
+        self.pygreen.set_folder(folder)
+        app = pygreen.create_app(root_path=folder)
+        pygreen.configure_views(app, self.pygreen.file_renderer,
+            static_sender=self.pygreen.send_static)
+        client = app.test_client()
+        response = client.get("/static/test.txt")
+        self.assertEqual(response.data, b"test\n")
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+        etag = response.headers["ETag"]
+        response = client.get("/static/test.txt",
+            headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        response = client.get("/static/test.txt", headers={"Range": "bytes=1-2"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"es")
+        self.assertEqual(response.headers["Content-Range"], "bytes 1-2/5")
+        response = client.get("/static/test.txt",
+            headers={"Range": "bytes=1-2", "If-Range": '"other"'})
+        self.assertEqual(response.status_code, 200)
+        response = client.get("/static/test.txt", headers={"Range": "bytes=9-"})
+        self.assertEqual(response.status_code, 416)
+        # unsupported ranges are ignored
+        for header in ("bytes=0-1,3-4", "items=0-1"):
+            response = client.get("/static/test.txt",
+                headers={"Range": header})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b"test\n")
+        self.assertEqual(client.get("/static/missing.txt").status_code, 404)
+
+        versioned = os.path.abspath(os.path.join(folder, "static/test.txt"))
+        self.pygreen.manager.versioned_outputs = lambda: set([versioned])
+        response = client.get("/static/test.txt")
+        self.assertEqual(response.headers["Cache-Control"],
+            "public, max-age=31536000, immutable")
+
+    def test_gen_profile(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        out = os.path.join(_output, "out")
+        stats = os.path.join(_output, "test.prof")
+        profiler = pygreen.GenProfiler("templates/test.mako", stats)
+        self.pygreen.gen_static(out, profiler=profiler)
+        report = profiler.report()
+        self.assertEqual(sorted(report["files"]),
+            ["static/test.txt", "templates/test.mako"])
+        page = report["files"]["templates/test.mako"]
+        self.assertTrue(page["render"] >= page["postprocess"] > 0)
+        self.assertTrue(page["wall"] >= page["render"] + page["write"])
+        self.assertEqual(sorted(report["templates"]),
+            ["templates/layouts/base.mako", "templates/test.mako"])
+        self.assertEqual(sorted(report["phases"]), ["generate", "list"])
+        self.assertTrue(os.path.exists(stats))
+
+        profiler = pygreen.GenProfiler()
+        self.pygreen.gen_static(out, jobs=2, profiler=profiler)
+        report_path = os.path.join(_output, "report.json")
+        profiler.save(report_path)
+        with open(report_path, "rb") as _file:
+            report = json.loads(_file.read().decode("utf-8"))
+        self.assertEqual(sorted(report["files"]),
+            ["static/test.txt", "templates/test.mako"])
+        self.assertEqual(report["template_misses"], 2)
+
+    def test_workers(self):
+        folder = os.path.join(_folder, "input_gen_static")
+        app = pygreen.make_wsgi_app(folder, config_file=None)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(5)
+        sock.setblocking(0)
+        before = os.times()
+        pid = pygreen._fork_worker(sock, app)
+        try:
+            response = urllib2.urlopen("http://127.0.0.1:%d/test.mako"
+                % sock.getsockname()[1])
+            self.assertIn(b"3+2=5", response.read())
+            # an idle worker waits for connections without spinning
+            time.sleep(1)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            sock.close()
+        after = os.times()
+        self.assertLess(after[2] + after[3] - before[2] - before[3], 0.5)
+
+    def test_reap_children(self):
+        pids = []
+        for status in (0, 3):
+            pid = os.fork()
+            if not pid:
+                os._exit(status)
+            pids.append(pid)
+        worker, other = pids
+        for _ in range(50):
+            exited = pygreen._reap_children([worker])
+            if exited:
+                break
+            time.sleep(0.1)
+        self.assertEqual(exited, [(worker, 0)])
+        # the status of the other children is left to their parent
+        self.assertEqual(os.waitpid(other, 0), (other, 3 << 8))
+
+    def test_run_workers_signals(self):
+        folder = os.path.join(_folder, "input_gen_static")
+        free = socket.socket()
+        free.bind(("127.0.0.1", 0))
+        port = free.getsockname()[1]
+        free.close()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                self.pygreen.set_folder(folder)
+                self.pygreen.config_file = None
+                self.pygreen.run_workers("127.0.0.1", port, workers=1)
+                status = 0
+            finally:
+                os._exit(status)
+        done = 0
+        try:
+            for _ in range(50):
+                try:
+                    urllib2.urlopen("http://127.0.0.1:%d/static/test.txt"
+                        % port).read()
+                    break
+                except IOError:
+                    time.sleep(0.1)
+            os.kill(pid, signal.SIGHUP)
+            os.kill(pid, signal.SIGTERM)
+            for _ in range(50):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    break
+                time.sleep(0.1)
+            self.assertEqual((done, status), (pid, 0))
+        finally:
+            if not done:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+
+    def test_lazy_init(self):
+        green = pygreen.PyGreen()
+        self.assertIsNone(green._templates)
+        self.assertIsNone(green._manager)
+        green.set_folder(os.path.join(_folder, "input_mako"))
+        self.assertEqual(green.templates.directories[0], green.folder)
+        manager = green.manager
+        self.assertIs(green.manager, manager)
+        green.set_production(False)
+        self.assertIsNone(green._manager)
+
+    def test_gen_sync(self):
+        self.pygreen.set_folder(os.path.join(_folder, "input_gen_static"))
+        out = os.path.join(_output, "out")
+        self.assertEqual(self.pygreen.gen_static(out, sync=True),
+            {"written": 2, "unchanged": 0, "deleted": 0})
+        # the mode open() would give, without changing the umask
+        self.assertEqual(os.stat(os.path.join(out, "test.html")).st_mode
+            & 0o777, 0o666 & ~pygreen._UMASK)
+        os.utime(os.path.join(out, "test.html"), (0, 0))
+        os.makedirs(os.path.join(out, "old"))
+        for name in ("old/page.html", ".hidden"):
+            with open(os.path.join(out, name), "wb") as _file:
+                _file.write(b"old")
+        self.assertEqual(self.pygreen.gen_static(out, jobs=2, sync=True),
+            {"written": 0, "unchanged": 2, "deleted": 1})
+        self.assertEqual(os.path.getmtime(os.path.join(out, "test.html")), 0)
+        self.assertFalse(os.path.exists(os.path.join(out, "old")))
+        self.assertTrue(os.path.exists(os.path.join(out, ".hidden")))
+        self.assertEqual(sorted(os.listdir(out)),
+            [".hidden", "static", "test.html"])
+
+    def test_gen_watch(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_gen_static"), site,
+            ignore=shutil.ignore_patterns(".*"))
+        self.pygreen.set_folder(site)
+        out = os.path.join(_output, "out")
+        self.pygreen.gen_static(out, incremental=True)
+        watcher = pygreen.GenWatcher(self.pygreen, out, debounce=0,
+            sync=True)
+        self.assertIsNone(watcher.check())
+        page = os.path.join(site, "templates", "test.mako")
+        with open(page, "ab") as _file:
+            _file.write(b"changed")
+        os.utime(page, (time.time() + 10, time.time() + 10))
+        with open(os.path.join(site, "templates", "new.mako"), "wb") as _file:
+            _file.write(b"new")
+        self.assertEqual(watcher.check(),
+            {"written": 2, "unchanged": 1, "deleted": 0})
+        with open(os.path.join(out, "test.html"), "rb") as _file:
+            self.assertIn(b"changed", _file.read())
+        self.assertIsNone(watcher.check())
+        os.remove(os.path.join(site, "static", "test.txt"))
+        self.assertEqual(watcher.check(),
+            {"written": 0, "unchanged": 2, "deleted": 1})
+
+        # the excluded directories are not watched
+        self.pygreen.directory_exclusion = ["node_modules"]
+        modules = os.path.abspath(os.path.join(site, "static", "node_modules"))
+        os.makedirs(modules)
+        with open(os.path.join(modules, "x.js"), "wb") as _file:
+            _file.write(b"x")
+        self.assertIsNone(watcher.check())
+        self.assertFalse([p for p in watcher._mtimes if p.startswith(modules)])
+
+        # with watchdog, only the paths of the events are checked
+        watcher._events = set([os.path.join(modules, "x.js")])
+        self.assertIsNone(watcher.check())
+        with open(page, "ab") as _file:
+            _file.write(b" again")
+        os.utime(page, (time.time() + 20, time.time() + 20))
+        self.assertIsNone(watcher.check())
+        watcher._events.add(os.path.abspath(page))
+        self.assertEqual(watcher.check(),
+            {"written": 1, "unchanged": 1, "deleted": 0})
+
+    def test_data_route(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_data"), site)
+        self.pygreen.set_folder(site)
+        for ext in ("csv", "jsonl", "yml"):
+            self.pygreen.add_data_route("data/products.%s" % ext,
+                "includes/product.mako", "products/{sku}.html")
+        self.assertEqual(self.pygreen.get("products/2.html").strip(),
+            b"Chair: 25")
+        out = os.path.join(_output, "out")
+        self.assertEqual(self.pygreen.gen_static(out, incremental=True,
+            jobs=2)["written"], 6)
+        expected = {"1": b"Big\nlamp: 10", "3": b"Desk: 40",
+            "4": b"Shelf: 15", "6": b"Rug: 5"}
+        for sku, content in expected.items():
+            with open(os.path.join(out, "products", sku + ".html"),
+                    "rb") as _file:
+                self.assertEqual(_file.read().strip(), content)
+
+        data = os.path.join(site, "data", "products.jsonl")
+        with open(data, "ab") as _file:
+            _file.write(b'{"sku": 7, "name": "Lamp", "price": 12}\n')
+        os.utime(data, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.pygreen.gen_static(out, incremental=True),
+            {"written": 3, "unchanged": 4, "deleted": 0})
+
+    def test_data_route_errors(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_data"), site)
+        self.pygreen.set_folder(site)
+        self.pygreen.add_data_route("data/products.csv",
+            "includes/product.mako", "products/{sku}.html")
+        route = self.pygreen.add_data_route("data/missing.csv",
+            "includes/product.mako", "missing/{sku}.html")
+        # a missing dataset only breaks its own pages
+        app = pygreen.create_app(root_path=site)
+        pygreen.configure_views(app, self.pygreen.file_renderer)
+        client = app.test_client()
+        self.assertEqual(client.get("/products/2.html").status_code, 200)
+        self.assertEqual(client.get("/missing/2.html").status_code, 404)
+        # the dataset is not read for the paths of other routes
+        self.assertIsNone(route.record("products/2.html"))
+        self.assertIsNone(route._index)
+
+        data = (b"sku: 1\nnote: |\n  --- not a marker\n  ...\n---  \n"
+            b"sku: 2\n...\n---\nsku: 3\n")
+        records = list(pygreen._yaml_records(io.BytesIO(data)))
+        self.assertEqual([r for _, r in records], [
+            {"sku": 1, "note": "--- not a marker\n...\n"},
+            {"sku": 2}, {"sku": 3}])
+        for offset, record in records:
+            self.assertEqual(next(pygreen._yaml_records(io.BytesIO(data),
+                offset))[1], record)
+
+    def test_gen_shards(self):
+        site = os.path.join(_output, "site")
+        shutil.copytree(os.path.join(_folder, "input_data"), site)
+        self.pygreen.set_folder(site)
+        self.pygreen.add_data_route("data/products.csv",
+            "includes/product.mako", "products/{sku}.html")
+        self.pygreen.add_data_route("data/products.jsonl",
+            "includes/product.mako", "products/{sku}.html")
+        shards = [os.path.join(_output, "shard%d" % i) for i in range(3)]
+        written = 0
+        for i, shard in enumerate(shards):
+            written += self.pygreen.gen_static(shard, incremental=True,
+                shard=(i, 3))["written"]
+        self.assertEqual(written, 4)
+        out = os.path.join(_output, "out")
+        os.makedirs(out)
+        with open(os.path.join(out, "old.html"), "wb") as _file:
+            _file.write(b"old")
+        self.assertEqual(pygreen.merge_shards(out, shards, sync=True), 4)
+        self.assertEqual(sorted(os.listdir(os.path.join(out, "products"))),
+            ["1.html", "2.html", "3.html", "4.html"])
+        self.assertFalse(os.path.exists(os.path.join(out, "old.html")))
+        self.assertEqual(self.pygreen.gen_static(out, incremental=True),
+            {"written": 0, "unchanged": 4, "deleted": 0})
+        shard = [s for s in shards
+            if os.path.isdir(os.path.join(s, "products"))][0]
+        with self.assertRaises(ValueError):
+            pygreen.merge_shards(out, [shard, shard])
+
+        # the shards writing into the same folder keep the files of the
+        # others
+        shared = os.path.join(_output, "shared")
+        os.makedirs(shared)
+        with open(os.path.join(shared, "old.html"), "wb") as _file:
+            _file.write(b"old")
+        deleted = 0
+        for i in range(3):
+            deleted += self.pygreen.gen_static(shared, sync=True,
+                shard=(i, 3))["deleted"]
+        self.assertEqual(deleted, 1)
+        self.assertEqual(sorted(os.listdir(shared)), ["products"])
+        self.assertEqual(len(os.listdir(os.path.join(shared, "products"))), 4)
+
+    def test_postprocessor(self):
+        page = ('<p>see page.mako</p><!-- <a href="a.mako"> -->'
+            '<a class=x href="b.haml#top">b.mako</a>'
+            '<IMG SRC=\'c.mako?x=1\' alt="d.mako">'
+            '<script src="e.mako">var f = "<a href=f.mako>";</script>')
+        self.assertEqual(pygreen.change_href_to_html(page),
+            '<p>see page.mako</p><!-- <a href="a.mako"> -->'
+            '<a class=x href="b.html#top">b.mako</a>'
+            '<IMG SRC=\'c.html?x=1\' alt="d.mako">'
+            '<script src="e.html">var f = "<a href=f.mako>";</script>')
+
+        postprocessor = pygreen.default_postprocessor()
+        postprocessor.add_attribute_transform(
+            lambda tag, attribute, value: "/root/" + value, ["src"])
+        postprocessor.add_text_transform(lambda text: text.upper())
+        self.assertEqual(postprocessor(page),
+            '<p>SEE PAGE.MAKO</p><!-- <a href="a.mako"> -->'
+            '<a class=x href="b.html#top">B.MAKO</a>'
+            '<IMG SRC=\'/root/c.html?x=1\' alt="d.mako">'
+            '<script src="/root/e.html">var f = "<a href=f.mako>";</script>')
+
+        # a ">" in a quoted attribute value does not end the tag
+        page = '<a title="x>y" href="a.mako">t</a><img alt=\'>\' src=b.mako>'
+        self.assertEqual(pygreen.change_href_to_html(page),
+            '<a title="x>y" href="a.html">t</a><img alt=\'>\' src="b.html">')
+        self.assertEqual(postprocessor(page),
+            '<a title="x>y" href="a.html">T</a>'
+            '<img alt=\'>\' src="/root/b.html">')
+
+        # outside of values, quotes are characters
+        page = "<img alt=Don't src=a.mako><a title=it's href=b.mako>t</a>"
+        self.assertEqual(pygreen.change_href_to_html(page),
+            '<img alt=Don\'t src="a.html"><a title=it\'s href="b.html">t</a>')
+        self.assertEqual(postprocessor(page),
+            '<img alt=Don\'t src="/root/a.html">'
+            '<a title=it\'s href="b.html">T</a>')
+
     def test_haml_gen(self):
         self.pygreen.set_folder(os.path.join(_folder, "input_haml_gen"))
         self.pygreen.set_preprocessor(haml.preprocessor)
@@ -64,6 +770,26 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(value.strip(), b"<h1>Test</h1>")
 
 
+    def test_haml_cache(self):
+        counts = []
+        for _ in range(2):
+            green = pygreen.PyGreen()
+            green.cache_dir = self.pygreen.cache_dir
+            green.set_folder(os.path.join(_folder, "input_haml_markdown"))
+            green.set_preprocessor(haml.preprocessor)
+            # compiled again, without the modules of the previous run
+            modules = os.path.join(green.cache_dir, "templates")
+            if os.path.exists(modules):
+                shutil.rmtree(modules)
+            self.assertEqual(green.get("test.html").strip(), b"<h1>Test</h1>")
+            cache = green.templates.template_args["lexer_cls"].cache
+            counts.append((cache.misses, cache.hits))
+        self.assertEqual(counts, [(1, 0), (0, 1)])
+        self.assertEqual(green.templates.template_args["preprocessor"],
+            [haml.preprocessor])
+        self.assertIn("<%text>Test\n====</%text>",
+            green.preprocessed_source("test.html"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1 @@
+${record["name"]}: ${record["price"]}
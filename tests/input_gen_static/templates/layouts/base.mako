@@ -0,0 +1 @@
+<div class="output">${self.body()}</div>
@@ -0,0 +1,2 @@
+<%inherit file="layouts/base.mako"/>
+3+2=${3+2} <a href="test.mako">test</a>